@@ -0,0 +1,600 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+"""Benchmarks for jpydict
+
+Generate a synthetic JMdict file, import it, then measure query latencies,
+autocompletion, text annotation and kana to romaji conversion throughput.
+Results are output as JSON, to be compared between versions.
+
+"""
+
+import os
+import re
+import sys
+import time
+import json
+import random
+import shutil
+import sqlite3
+import tempfile
+import subprocess
+import platform
+import gzip
+import StringIO
+import httplib
+import BaseHTTPServer
+import urllib
+import threading
+
+import jpydict
+
+jpydict_path = os.path.splitext(jpydict.__file__)[0] + '.py'
+
+
+# (plain kana, kana followed by small ya/yu/yo, small ya/yu/yo, small tsu)
+hiragana = (u'あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをんがぎぐげござじずぜぞだでどばびぶべぼぱぴぷぺぽ',
+            u'きしちにひみりぎじびぴ', u'ゃゅょ', u'っ')
+katakana = (u'アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモヤユヨラリルレロワンガギグゲゴザジズゼゾダデドバビブベボパピプペポ',
+            u'キシチニヒミリギジビピ', u'ャュョ', u'ッ')
+kanji = u'日一国会人年大十二本中長出三同時政事自行社見月分議後前民生連五発間対上部東者党地合市業内相方四定今回新場金員九入選立開手米力学問高代明実円関決子動京全目表戦経通外最言氏現理調体化田当八六約主題下首意法不来作性的要用制治度務強気小七成期公持野協取都和統以機平総加山思家話世受区領多県続進正安設保改数記院女初北午指権心界支第産結百派点教報済書府活原先共得解名交資予川向際査勝面委告軍文反元重近千考判認画海参売利組知案道信策集在件団別物側任引使求所次水半品昨論計死官増係感特情投示変打男基私各始島直両朝革価式確村提運終挙果西勢減台広容必応演電歳住争談能無再位置企真流格有疑口過局少放税検藤町常校料沢裁状工建語球営空職証土与急止送援供可役構木割聞身費付施切由説転食比難防補車優夫研収断井何南石足違消境神番規術護展態導鮮備宅害配副算視条幹独警宮究育席輸訪楽起万着乗店述残想線率病農州武声質念待試族象銀域助労例衛然早張映限親額監環験追審商葉義伝働形景落欧担好退準賞訴辺造英被株頭技低毎医復仕去姿味負閣韓渡失移差衆個門写評課末守若脳極種美岡影命含福蔵量望松非撃佐核観察整段横融型白深字答夜製票況音申様財港識注呼渉達'
+pos_entities = ['n', 'v1', 'v5r', 'vt', 'vi', 'adj-i', 'adj-na', 'adv', 'exp', 'n-suf']
+field_entities = ['comp', 'med', 'ling', 'math', 'food', 'sports']
+dial_entities = ['ksb', 'ktb', 'osb']
+priorities = ['news1', 'news2', 'ichi1', 'ichi2', 'spec1', 'spec2', 'gai1', 'gai2'] + ['nf%02d' % i for i in range(1, 49)]
+words = ('eat time dictionary house water person book go come see big small run'
+         ' language computer write read old new good bad way day hand eye word').split()
+
+
+def generate_jmdict(f, n, seed=0):
+  """Write a synthetic JMdict XML file of n entries
+
+  Entries use the same elements as the real dictionary, including entities
+  declared in the DTD.
+  """
+
+  rnd = random.Random(seed)
+
+  def kana_word(table):
+    plain, yoon, small_y, sokuon = table
+    word = []
+    for _ in range(rnd.randint(1, 5)):
+      r = rnd.random()
+      if r < .1:
+        word.append(rnd.choice(yoon) + rnd.choice(small_y))
+      elif r < .15:
+        # consonant syllable (not a vowel, nor n)
+        word.append(sokuon + rnd.choice(plain[5:].replace(u'ん', '').replace(u'ン', '')))
+      else:
+        word.append(rnd.choice(plain))
+    if table is katakana and rnd.random() < .2:
+      word.append(u'ー')
+    return ''.join(word)
+
+  w = f.write
+  w('<?xml version="1.0" encoding="UTF-8"?>\n')
+  w('<!DOCTYPE JMdict [\n<!ELEMENT JMdict (entry*)>\n')
+  for name in pos_entities + field_entities + dial_entities:
+    w('<!ENTITY %s "%s description">\n' % (name, name))
+  w(']>\n<JMdict>\n')
+  for i in range(n):
+    e = [u'<entry>\n<ent_seq>%d</ent_seq>\n' % (1000000 + 10 * i)]
+    for _ in range(rnd.choice([0, 1, 1, 1, 2])):
+      e.append(u'<k_ele>\n<keb>%s</keb>\n' % ''.join(rnd.choice(kanji) for _ in range(rnd.randint(1, 4))))
+      if rnd.random() < .2:
+        e.append(u'<ke_pri>%s</ke_pri>\n' % rnd.choice(priorities))
+      e.append(u'</k_ele>\n')
+    for _ in range(rnd.choice([1, 1, 2])):
+      reb = kana_word(hiragana if rnd.random() < .8 else katakana)
+      e.append(u'<r_ele>\n<reb>%s</reb>\n' % reb)
+      if rnd.random() < .2:
+        e.append(u'<re_pri>%s</re_pri>\n' % rnd.choice(priorities))
+      e.append(u'</r_ele>\n')
+    for _ in range(rnd.choice([1, 1, 2, 3])):
+      e.append(u'<sense>\n')
+      for p in rnd.sample(pos_entities, rnd.choice([0, 1, 1, 2])):
+        e.append(u'<pos>&%s;</pos>\n' % p)
+      if rnd.random() < .1:
+        e.append(u'<field>&%s;</field>\n' % rnd.choice(field_entities))
+      if rnd.random() < .05:
+        e.append(u'<dial>&%s;</dial>\n' % rnd.choice(dial_entities))
+      for _ in range(rnd.choice([1, 1, 2, 3])):
+        e.append(u'<gloss>%s</gloss>\n' % ' '.join(rnd.choice(words) for _ in range(rnd.randint(1, 4))))
+      if rnd.random() < .1:
+        e.append(u'<gloss xml:lang="ger">%s</gloss>\n' % rnd.choice(words))
+      e.append(u'</sense>\n')
+    e.append(u'</entry>\n')
+    w(''.join(e).encode('utf-8'))
+  w('</JMdict>\n')
+
+
+def percentiles(values):
+  """Return statistics of a list of durations, in milliseconds"""
+  values = sorted(values)
+  n = len(values)
+  def pct(p):
+    return values[min(n - 1, int(n * p / 100.))] * 1000
+  return {
+      'count': n,
+      'mean': sum(values) / n * 1000,
+      'p50': pct(50),
+      'p90': pct(90),
+      'p99': pct(99),
+      'max': values[-1] * 1000,
+      }
+
+
+def bench_import(db, xml, n, jobs, incremental=False):
+  """Import a JMdict file in a child process, measure time and memory"""
+  args = [sys.executable, jpydict_path, '-d', db, '--import-file', xml, '-j', str(jobs)]
+  if incremental:
+    args.append('--incremental')
+  rusage = None
+  with open(os.devnull, 'w') as devnull:
+    t0 = time.time()
+    p = subprocess.Popen(args, stdout=devnull)
+    if hasattr(os, 'wait4'):
+      # wait4() also returns the resource usage of the child (Unix only)
+      _, status, rusage = os.wait4(p.pid, 0)
+      # exit code, or negative signal number (like Popen.returncode)
+      status = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+      p.returncode = status
+    else:
+      status = p.wait()
+    duration = time.time() - t0
+  if status != 0:
+    raise subprocess.CalledProcessError(status, args)
+  result = {
+      'duration': duration,
+      'entries_per_s': n / duration,
+      }
+  if rusage is not None:
+    result['peak_rss_kb'] = rusage.ru_maxrss  # kilobytes on Linux
+  return result
+
+
+def query_patterns(conn, count, seed=0):
+  """Return search patterns sampled from the database, by pattern class"""
+  rnd = random.Random(seed)
+  kebs = [r[0] for r in conn.execute("SELECT keb FROM kanji")]
+  rebs = [r[0] for r in conn.execute("SELECT reb FROM reading")]
+  romajis = [jpydict.kana2romaji(s) for s in rebs]
+
+  def sample(l, f):
+    return [f(rnd.choice(l)) for _ in range(count)]
+
+  return {
+      'prefix_kanji': sample(kebs, lambda s: s[:1]),
+      'prefix_kana': sample(rebs, lambda s: s[:2]),
+      'romaji': sample(romajis, lambda s: s[:3]),
+      'gloss': sample(words, lambda s: '/' + s),
+      'leading_wildcard': sample(rebs, lambda s: '*' + s[-2:]),
+      'single_wildcard': sample(rebs, lambda s: '?' + s[1:3]),
+      }
+
+
+def bench_queries(db, count, limit, seed=0):
+  """Measure query latencies, by pattern class"""
+  conn = sqlite3.connect(db)
+  results = {}
+  for name, patterns in sorted(query_patterns(conn, count, seed).items()):
+    durations = []
+    for pattern in patterns:
+      t0 = time.time()
+      jpydict.Query(conn, pattern, limit=limit).execute()
+      durations.append(time.time() - t0)
+    results[name] = percentiles(durations)
+  conn.close()
+  return results
+
+
+def bench_completion(db, count, seed=0):
+  """Measure completion index build time and per-keystroke latency
+
+  Keystrokes are simulated by completing all the prefixes of sampled keys.
+  """
+  rnd = random.Random(seed)
+  conn = sqlite3.connect(db)
+  t0 = time.time()
+  completer = jpydict.Completer(conn)
+  duration = time.time() - t0
+  conn.close()
+
+  durations = []
+  for _ in range(count):
+    key = completer.key(rnd.randrange(completer.size)).decode('utf-8')
+    for n in range(1, len(key) + 1):
+      t0 = time.time()
+      completer.complete(key[:n])
+      durations.append(time.time() - t0)
+  return {
+      'build': {'duration': duration, 'keys': completer.size, 'memory_kb': completer.memory // 1024},
+      'keystroke': percentiles(durations),
+      }
+
+
+def bench_annotate(db, lines, seed=0):
+  """Measure text annotation throughput
+
+  Text lines are made of words sampled from the dictionary.
+  """
+  rnd = random.Random(seed)
+  conn = sqlite3.connect(db)
+  words = [r[0] for r in conn.execute("SELECT keb FROM kanji UNION ALL SELECT reb FROM reading")]
+  text = [u''.join(rnd.choice(words) for _ in range(rnd.randint(3, 15))) for _ in range(lines)]
+  nchars = sum(len(s) for s in text)
+
+  t0 = time.time()
+  annotator = jpydict.Annotator(conn)
+  results = {'build': time.time() - t0}
+  t0 = time.time()
+  for s in text:
+    for _ in annotator.segment(s):
+      pass
+  results['segment_chars_per_s'] = nchars / (time.time() - t0)
+  t0 = time.time()
+  for _ in annotator.annotate(text):
+    pass
+  results['annotate_chars_per_s'] = nchars / (time.time() - t0)
+  conn.close()
+  return results
+
+
+def bench_kana2romaji(db, rounds):
+  """Measure kana to romaji conversion throughput"""
+  conn = sqlite3.connect(db)
+  rebs = [r[0] for r in conn.execute("SELECT reb FROM reading")]
+  conn.close()
+  nchars = sum(len(s) for s in rebs) * rounds
+
+  def run(f):
+    t0 = time.time()
+    for _ in range(rounds):
+      f(rebs)
+    duration = time.time() - t0
+    return {
+        'strings_per_s': len(rebs) * rounds / duration,
+        'chars_per_s': nchars / duration,
+        }
+
+  results = {'regex': run(lambda l: [baseline_kana2romaji(s) for s in l])}
+  results['uncached'] = run(lambda l: [jpydict._kana2romaji(s) for s in l])
+  jpydict.kana2romaji_cache.clear()
+  results['cached'] = run(lambda l: [jpydict.kana2romaji(s) for s in l])
+  return results
+
+
+def start_server(db):
+  """Start a lookup server on a free local port, return it"""
+  server = jpydict.LookupServer(('127.0.0.1', 0), db)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server
+
+
+def bench_server(db, count, clients, limit, seed=0):
+  """Measure lookup server throughput and latencies
+
+  clients threads send requests concurrently, each one on its own keep-alive
+  connection: count searches per pattern class (GET /search), then batches of
+  100 terms (POST /lookup).
+  """
+  conn = sqlite3.connect(db)
+  patterns = [p for l in query_patterns(conn, count, seed).values() for p in l]
+  conn.close()
+  random.Random(seed).shuffle(patterns)
+  server = start_server(db)
+  port = server.server_address[1]
+
+  def run(requests):
+    durations = []
+    def client(requests):
+      http = httplib.HTTPConnection('127.0.0.1', port)
+      for method, path, body in requests:
+        t0 = time.time()
+        http.request(method, path, body)
+        response = http.getresponse()
+        response.read()
+        if response.status != 200:
+          raise RuntimeError("%s %s failed: %d" % (method, path, response.status))
+        durations.append(time.time() - t0)
+      http.close()
+    threads = [threading.Thread(target=client, args=(requests[i::clients],)) for i in range(clients)]
+    t0 = time.time()
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    return time.time() - t0, durations
+
+  try:
+    searches = [('GET', '/search?' + urllib.urlencode({'q': p.encode('utf-8'), 'limit': limit}), None)
+                for p in patterns]
+    duration, durations = run(searches)
+    results = {'search': percentiles(durations)}
+    results['search']['requests_per_s'] = len(searches) / duration
+    batches = [('POST', '/lookup', json.dumps({'terms': patterns[i:i+100], 'limit': limit}))
+               for i in range(0, len(patterns), 100)]
+    duration, durations = run(batches)
+    results['lookup'] = percentiles(durations)
+    results['lookup']['terms_per_s'] = len(patterns) / duration
+  finally:
+    server.shutdown()
+    server.server_close()
+  return results
+
+
+def check_server_pages(db, limit=20):
+  """Compare paged searches through the lookup server with Query results
+
+  Return error messages, one per search whose pages differ.
+  """
+  conn = sqlite3.connect(db)
+  server = start_server(db)
+  http = httplib.HTTPConnection('127.0.0.1', server.server_address[1])
+  errors = []
+  try:
+    for q in ['/' + w for w in words] + [u'か', u'ka', u'*ん', u'#comp']:
+      expected = [e.seq for e in jpydict.Query(conn, q).execute()]
+      seqs, cursor, error = [], None, None
+      while True:
+        params = {'q': q.encode('utf-8'), 'limit': limit}
+        if cursor is not None:
+          params['cursor'] = json.dumps(cursor)
+        http.request('GET', '/search?' + urllib.urlencode(params))
+        response = http.getresponse()
+        data = json.loads(response.read())
+        if response.status != 200:
+          error = "%r: page %d: %s" % (q, len(seqs) // limit, data['error'])
+          break
+        seqs += [e['seq'] for e in data['result']]
+        cursor = data['cursor']
+        if cursor is None:
+          break
+      if error is None and seqs != expected:
+        error = "%r: %d paged results, %d expected" % (q, len(seqs), len(expected))
+      if error is not None:
+        errors.append(error)
+  finally:
+    http.close()
+    server.shutdown()
+    server.server_close()
+    conn.close()
+  return errors
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serve the dictionary file like a static HTTP server, for download checks
+
+  The served file is server.data, with validators server.etag and
+  server.last_modified. Conditional (If-None-Match) and range (Range and
+  If-Range) requests are supported. If server.truncate is set, the next
+  response is cut after this number of bytes. Request headers are appended
+  to server.requests.
+  """
+
+  def do_GET(self):
+    server = self.server
+    server.requests.append(self.headers)
+    if self.headers.getheader('If-None-Match') == server.etag:
+      self.send_response(304)
+      self.end_headers()
+      return
+    start = 0
+    m = re.match(r'bytes=(\d+)-$', self.headers.getheader('Range') or '')
+    if m and self.headers.getheader('If-Range') in (server.etag, server.last_modified):
+      start = int(m.group(1))
+      if start >= len(server.data):
+        self.send_response(416)
+        self.end_headers()
+        return
+      self.send_response(206)
+      self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(server.data) - 1, len(server.data)))
+    else:
+      self.send_response(200)
+    body = server.data[start:]
+    self.send_header('Content-Length', str(len(body)))
+    self.send_header('ETag', server.etag)
+    self.send_header('Last-Modified', server.last_modified)
+    self.end_headers()
+    if server.truncate is not None:
+      body = body[:server.truncate]
+      server.truncate = None
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+def check_download(tmp_dir, xml, n):
+  """Check conditional and resumed downloads against a local HTTP stand-in
+
+  Return error messages, one per failed step.
+  """
+  server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StandInHandler)
+  with open(xml, 'rb') as f:
+    server.data = gzip_compress(f.read())
+  server.etag, server.last_modified = '"v1"', 'Mon, 01 Jan 2018 00:00:00 GMT'
+  server.truncate = None
+  server.requests = []
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+
+  db = os.path.join(tmp_dir, 'download.sqlite3')
+  path = os.path.join(tmp_dir, 'JMdict.gz')
+  url = 'http://127.0.0.1:%d/JMdict.gz' % server.server_address[1]
+  errors = []
+
+  def loader():
+    return jpydict.JMDictLoader(db, lambda msg, progress: None, url=url, download_path=path)
+
+  def load(step, expected, **headers):
+    """Run load_url(), check its result and the headers of the request"""
+    try:
+      result = loader().load_url()
+    except Exception as e:
+      result = e
+    if expected is Exception:
+      if not isinstance(result, Exception):
+        errors.append("%s: load did not fail" % step)
+    elif result != expected:
+      errors.append("%s: load returned %r, expected %r" % (step, result, expected))
+    for name, value in headers.items():
+      value_sent = server.requests[-1].getheader(name.replace('_', '-'))
+      if value_sent != value:
+        errors.append("%s: %s header is %r, expected %r" % (step, name, value_sent, value))
+
+  def check_loaded(step):
+    conn = sqlite3.connect(db)
+    count = conn.execute("SELECT count(*) FROM entry").fetchone()[0]
+    conn.close()
+    if count != n:
+      errors.append("%s: %d entries loaded, expected %d" % (step, count, n))
+    with open(path, 'rb') as f:
+      if f.read() != server.data:
+        errors.append("%s: downloaded file differs" % step)
+
+  try:
+    half = len(server.data) // 2
+    server.truncate = half
+    load("interrupted download", Exception, Range=None)
+    load("resumed download", True, Range='bytes=%d-' % half, If_Range=server.etag)
+    check_loaded("resumed download")
+    load("unchanged file", False, If_None_Match=server.etag)
+
+    # downloaded, but not loaded: a "not modified" response loads it
+    l = loader()
+    meta = l.read_download_meta()
+    meta['loaded'] = False
+    l.write_download_meta(meta)
+    l.db_output.close()
+    load("unchanged file, not loaded", True, If_None_Match=server.etag)
+    check_loaded("unchanged file, not loaded")
+
+    # file changed between an interrupted download and its resume
+    server.etag = '"v2"'
+    server.truncate = half
+    load("interrupted download of a new version", Exception, If_None_Match='"v1"')
+    server.etag = '"v3"'
+    load("resume of a changed version", True, Range='bytes=%d-' % half, If_Range='"v2"')
+    check_loaded("resume of a changed version")
+  finally:
+    server.shutdown()
+    server.server_close()
+  return errors
+
+
+def gzip_compress(data):
+  """Return data compressed in gzip format"""
+  buf = StringIO.StringIO()
+  with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+    f.write(data)
+  return buf.getvalue()
+
+
+def baseline_kana2romaji(txt):
+  """Convert kana to romaji with regular expressions, like previous versions"""
+  txt = unicode(txt)
+  txt = re.sub('|'.join(s for s, _ in jpydict.tbl_all), lambda m: jpydict.kana2romaji_map[m.group()], txt)
+  txt = re.sub(ur'[っッ]([bcdfghjkmnprstvwz])', r'\1\1', txt)
+  txt = re.sub(ur'([aeiou])ー', r'\1\1', txt)
+  txt = re.sub(ur'[・ー−―]', '-', txt)
+  txt = re.sub(ur'[っッ]', r'-tsu', txt)
+  txt = re.sub(ur'[\uff00-\uff5e]', lambda m: unichr(ord(m.group(0)) - 0xfee0), txt)
+  return txt.encode('ascii', 'replace')
+
+
+def check_kana2romaji(db, count, seed=0):
+  """Compare kana to romaji conversion with baseline_kana2romaji()
+
+  Texts are all the readings of the dictionary, all pairs of kana and special
+  characters, then count random texts. Return error messages, one per text
+  converted differently.
+  """
+  rnd = random.Random(seed)
+  conn = sqlite3.connect(db)
+  texts = [r[0] for r in conn.execute("SELECT reb FROM reading")]
+  conn.close()
+  chars = sorted(set(c for s, _ in jpydict.tbl_all for c in s))
+  chars += list(u'・−―ａＫ！～漢aK -') + [u'\uff00', u'\uff5f']
+  texts += [a + b for a in chars for b in chars]
+  texts += [u''.join(rnd.choice(chars) for _ in range(rnd.randint(1, 8))) for _ in range(count)]
+  errors = []
+  for s in texts:
+    romaji, expected = jpydict._kana2romaji(s, warn=False), baseline_kana2romaji(s)
+    if romaji != expected:
+      errors.append("%r: %s, expected %s" % (s, romaji, expected))
+  return errors
+
+
+def main():
+  import argparse
+  parser = argparse.ArgumentParser(description="Run jpydict benchmarks.")
+  parser.add_argument('-n', '--entries', type=int, default=20000,
+      help="number of generated dictionary entries (default: %(default)s)")
+  parser.add_argument('-q', '--queries', type=int, default=200,
+      help="number of queries per pattern class (default: %(default)s)")
+  parser.add_argument('--limit', type=int, default=25,
+      help="maximum number of results per query (default: %(default)s)")
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+      help="number of processes used to import the dictionary (default: %(default)s)")
+  parser.add_argument('-c', '--clients', type=int, default=8,
+      help="number of concurrent clients of the lookup server (default: %(default)s)")
+  parser.add_argument('--seed', type=int, default=0,
+      help="seed of the random generator (default: %(default)s)")
+  parser.add_argument('-o', '--output', metavar='FILE',
+      help="write results to a file instead of stdout")
+  parser.add_argument('--check', action='store_true',
+      help="run consistency checks on the generated dictionary instead of benchmarks,"
+      " exit with an error status if any fails")
+  args = parser.parse_args()
+
+  tmp_dir = tempfile.mkdtemp(prefix='jpydict-bench-')
+  try:
+    xml = os.path.join(tmp_dir, 'JMdict.xml')
+    db = os.path.join(tmp_dir, 'jpydict.sqlite3')
+    with open(xml, 'wb') as f:
+      generate_jmdict(f, args.entries, args.seed)
+
+    if args.check:
+      bench_import(db, xml, args.entries, args.jobs)
+      checks = [
+          ('kana2romaji', lambda: check_kana2romaji(db, 500 * args.queries, args.seed)),
+          ('server pages', lambda: check_server_pages(db)),
+          ('download', lambda: check_download(tmp_dir, xml, args.entries)),
+          ]
+      failed = False
+      for name, check in checks:
+        errors = check()
+        print "%s: %s" % (name, "%d errors" % len(errors) if errors else "ok")
+        for error in errors[:20]:
+          print "  " + error
+        failed = failed or errors
+      sys.exit(1 if failed else 0)
+
+    results = {
+        'version': jpydict.__version__,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'params': vars(args),
+        }
+    results['import'] = bench_import(db, xml, args.entries, args.jobs)
+    results['import_incremental'] = bench_import(db, xml, args.entries, args.jobs, incremental=True)
+    results['query'] = bench_queries(db, args.queries, args.limit, args.seed)
+    results['completion'] = bench_completion(db, args.queries, args.seed)
+    results['annotate'] = bench_annotate(db, 10 * args.queries, args.seed)
+    results['kana2romaji'] = bench_kana2romaji(db, 5)
+    results['server'] = bench_server(db, args.queries, args.clients, args.limit, args.seed)
+  finally:
+    shutil.rmtree(tmp_dir)
+
+  out = json.dumps(results, indent=2, sort_keys=True)
+  if args.output is None:
+    print out
+  else:
+    with open(args.output, 'w') as f:
+      f.write(out + '\n')
+
+if __name__ == '__main__':
+  main()
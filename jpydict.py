@@ -10,17 +10,48 @@ import xml.parsers.expat
 import urllib2
 import gzip
 import zlib
+import json
+import hashlib
+import collections
+import itertools
+import heapq
+import array
+import struct
+import mmap
+import multiprocessing
+import threading
+import traceback
+import codecs
+import shutil
+import cPickle as pickle
+import Queue
+import urlparse
+import BaseHTTPServer
 
 __version__ = '1.0.0'
 
-import gi
-gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk, Gdk, Pango
+
+def import_gtk():
+  """Import GTK modules
+
+  GTK is only imported when the GUI is used, so that the dictionary can be
+  imported and searched without it (and without a display).
+  """
+  global Gtk, Gdk, Pango, GLib
+  import gi
+  gi.require_version('Gtk', '3.0')
+  from gi.repository import Gtk, Gdk, Pango, GLib
 
 
 class JpydictApp:
 
-  def __init__(self, db=None):
+  # Delay after the last keystroke before searching, in milliseconds
+  search_delay = 200
+  # Number of entries fetched at once
+  page_size = 25
+
+  def __init__(self, db=None, cache=None):
+    import_gtk()
     self.window = Gtk.Window(Gtk.WindowType.TOPLEVEL)
     self.window.set_resizable(True)
     self.window.set_size_request(400, 500)
@@ -33,11 +64,20 @@ class JpydictApp:
     hbox = Gtk.Box.new(Gtk.Orientation.HORIZONTAL, 0)
 
     self.w_search = Gtk.ComboBoxText.new_with_entry()
-    self.w_search.get_child().connect('activate', lambda w: self.display_results(w.get_text()))
+    self.w_search.get_child().connect('activate', self.on_search_activate)
+    self.w_search.get_child().connect('changed', self.on_search_changed)
     self.w_search.get_child().modify_text(Gtk.StateType.NORMAL, Gdk.color_parse('black'))
     self.w_search.get_child().modify_font(Pango.FontDescription('sans 12'))
     hbox.pack_start(self.w_search, True, True, 0)
 
+    # Completions are provided by self.completer, not filtered by GTK
+    self.completer = None
+    self.w_completion = Gtk.EntryCompletion()
+    self.w_completion.set_model(Gtk.ListStore(str))
+    self.w_completion.set_text_column(0)
+    self.w_completion.set_match_func(lambda *args: True, None)
+    self.w_search.get_child().set_completion(self.w_completion)
+
     self.w_help = Gtk.Button.new_from_icon_name("help-faq", Gtk.IconSize.BUTTON)
     self.w_help.connect('clicked', self.show_help)
     hbox.pack_start(self.w_help, False, False, 0)
@@ -74,50 +114,149 @@ class JpydictApp:
     self.w_display.set_policy(Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.AUTOMATIC)
     self.w_display.add_with_viewport(self.w_result)
     vbox.pack_start(self.w_display, True, True, 0)
+    # Fetch more results when scrolling near the bottom
+    adj = self.w_display.get_vadjustment()
+    adj.connect('value-changed', self.fetch_more_results)
+    adj.connect('changed', self.fetch_more_results)
 
     self.window.show_all()
 
     # Connect to SQLite database
-    # Prompt for dictionary update if database is empty or does not exist
+    # Prompt for dictionary update if database is empty, does not exist or
+    # has been created by an older version
+    self.db = db
     self.conn = sqlite3.connect(db)
-    row = self.conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='version'").fetchone()
-    if row is None:
+    self.update_dialog = None
+    if database_is_filled(self.conn):
+      self.load_completer()
+    else:
       self.update_dictionary(self.window)
 
+    # Searches are run in background, as the user types
+    self.search_timeout = None
+    self.results_txt = None
+    self.results_cursor = None  # cursor of the next page, if any
+    if cache is None:
+      cache = QueryCache()
+    self.cache = cache
+    self.worker = SearchWorker(db, self.display_results, self.page_size, cache)
+    self.worker.start()
+
 
   def main(self):
     Gtk.main()
+    if self.cache.path is not None:
+      self.cache.save()
 
 
-  def display_results(self, txt):
-    buf = self.w_result.get_buffer()
-    buf.set_text('')
+  def search(self, txt):
+    """Search text in background, cancel the current search"""
+
+    if self.search_timeout is not None:
+      GLib.source_remove(self.search_timeout)
+      self.search_timeout = None
+    self.results_cursor = None
     if len(txt) == 0:
+      self.worker.cancel()
+      self.w_result.get_buffer().set_text('')
+    else:
+      self.worker.search(txt.decode('utf-8'))
+    return False
+
+  def fetch_more_results(self, adj):
+    """Request the next page of results if the view is near the bottom"""
+
+    if self.results_cursor is None:
       return
+    if adj.get_value() + 2 * adj.get_page_size() < adj.get_upper():
+      return
+    self.worker.search(self.results_txt, self.results_cursor)
+    self.results_cursor = None  # wait for the page
+
+  def on_search_changed(self, w):
+    if self.search_timeout is not None:
+      GLib.source_remove(self.search_timeout)
+    self.search_timeout = GLib.timeout_add(self.search_delay, self.search, w.get_text())
+    self.update_completions(w.get_text())
+
+  def load_completer(self):
+    """Build the completion index in background"""
+
+    def run():
+      conn = sqlite3.connect(self.db)
+      try:
+        completer = Completer(conn)
+      finally:
+        conn.close()
+      GLib.idle_add(setattr, self, 'completer', completer)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+  def update_completions(self, txt):
+    """Fill completions of the search text"""
+    model = self.w_completion.get_model()
+    model.clear()
+    if self.completer is None or not txt:
+      return
+    for s in self.completer.complete(txt.decode('utf-8')):
+      model.append([s.encode('utf-8')])
+
+  def on_search_activate(self, w):
+    txt = w.get_text()
+    self.search(txt)
+    if len(txt):
+      w.select_region(0, -1)
+      self.w_search.prepend_text(txt)
+      self.w_search.remove(10)
 
-    result = Query(self.conn, txt.decode('utf-8'), limit=50).execute()
+  def display_results(self, txt, cursor, result, next_cursor):
+    """Display a page of results
 
-    self.w_search.get_child().select_region(0, -1)
-    self.w_search.prepend_text(txt)
-    self.w_search.remove(10)
-    it = buf.get_end_iter()
+    cursor is None for the first page of a search, other pages are appended.
+    The page text is inserted at once, then tags are applied on it.
+
+    """
+
+    buf = self.w_result.get_buffer()
+    if cursor is None:
+      buf.set_text('')
+    parts = []
+    tags = []
+    pos = [0]
+    def add(txt, tag=None):
+      if tag is not None:
+        tags.append((pos[0], pos[0] + len(txt), tag))
+      parts.append(txt)
+      pos[0] += len(txt)
 
     # Format results (customize display format here)
     for e in result:
-      s = ', '.join(e.reb)
+      s = u', '.join(e.reb)
       if len(e.keb):
-        s = '%s / %s' % (', '.join(e.keb), s)
-      buf.insert_with_tags_by_name(it, "%s\n" % s, 'jap')
+        s = u'%s / %s' % (u', '.join(e.keb), s)
+      add(u"%s\n" % s, 'jap')
       for i,s in enumerate(e.sense):
-        buf.insert_with_tags_by_name(it, "%d) " % (i+1), 'sense-num')
+        add(u"%d) " % (i+1), 'sense-num')
         if len(s[0]):
-          buf.insert_with_tags_by_name(it, '%s  ' % ' '.join(s[0]), 'pos')
+          add(u'%s  ' % ' '.join(s[0]), 'pos')
         if len(s[1]):
-          buf.insert_with_tags_by_name(it, '[%s] ' % ' '.join(s[1]), 'attr')
-        buf.insert(it, '%s\n' % ', '.join(s[2]))
-
-    # Scroll at the top
-    self.w_display.get_vadjustment().set_value(0)
+          add(u'[%s] ' % ' '.join(s[1]), 'attr')
+        add(u'%s\n' % ', '.join(s[2]))
+
+    offset = buf.get_char_count()
+    buf.insert(buf.get_end_iter(), u''.join(parts))
+    for start, end, tag in tags:
+      buf.apply_tag_by_name(tag, buf.get_iter_at_offset(offset + start), buf.get_iter_at_offset(offset + end))
+
+    self.results_txt = txt
+    self.results_cursor = next_cursor
+    adj = self.w_display.get_vadjustment()
+    if cursor is None:
+      # Scroll at the top
+      adj.set_value(0)
+    self.fetch_more_results(adj)
 
   def show_help(self, w):
     dialog = Gtk.Dialog("Help", self.window)
@@ -154,18 +293,22 @@ class JpydictApp:
       "To translate Japanese into English, enter Japanese (kanjis, kanas, romanization)."))
     tbox.add(text_label(
       "To translate English into Japanese, start with a {em}/{/em} followed by the English text.\n"
-      "For instance, searching for {em}/dictionary{/em} will return {em}字引{/em}."))
+      "For instance, searching for {em}/dictionary{/em} will return {em}字引{/em}.\n"
+      "English words are matched anywhere in the translations, best matches first."))
     tbox.add(text_label(
       "Wildcards characters can be used for more refined searches.\n"
       "Without wildcards, search will match anything starting with the given pattern.\n"
       "  {em}*{/em} or {em}%{/em} replace any text: {em}pi*e{/em} searches for {em}pie{/em}, {em}pipe{/em}, {em}piece{/em}, ...\n"
       "  {em}?{/em} or {em}_{/em} replace a single character: {em}?回{/em} searches for {em}何回{/em}, {em}今回{/em} but not {em}一次回{/em}.", margin_top=5))
     tbox.add(text_label(
-      "Romanization uses the usual kana to latin conversion.\n"
-      "Long voyels are transcribed similarly to hiraganas:\n"
-      "{em}先生{/em} becomes {em}sensei{/em},"
-      " {em}大{/em} becomes {em}oo{/em},"
-      " {em}ローマ{/em} becomes {em}roomaji{/em}."))
+      "Results can be restricted to a part of speech or a field with {em}#{/em} followed by its code.\n"
+      "For instance, {em}#v5 ka{/em} searches for godan verbs, {em}#comp /file{/em} for computer terms."))
+    tbox.add(text_label(
+      "Romanization is converted to kana, using Hepburn or Kunrei-shiki ({em}shi{/em} or {em}si{/em}).\n"
+      "Long voyels can be written with a repeated voyel or as in hiraganas:\n"
+      "{em}先生{/em} is found with {em}sensei{/em} or {em}sensee{/em},"
+      " {em}東京{/em} with {em}toukyou{/em} or {em}tookyoo{/em},"
+      " {em}ローマ{/em} with {em}rooma{/em} or {em}rouma{/em}."))
 
     tbox.add(text_label("<b>Dictionary</b>", margin_top=10, margin_left=20))
     dict_box = Gtk.Box.new(Gtk.Orientation.HORIZONTAL, 0)
@@ -206,8 +349,22 @@ class JpydictApp:
     dialog.destroy()
 
   def update_dictionary(self, parent, on_update=None):
+    """Update the dictionary in a background thread
+
+    The database is replaced once updated (see update_database()), searches
+    can still be run meanwhile. Progress is shown in a dialog; closing it
+    aborts the update. on_update() is called from the GTK main loop when the
+    update is finished.
+
+    """
+
+    if self.update_dialog is not None:
+      self.update_dialog.present()  # already running
+      return
+
     dialog = Gtk.Dialog("Dictionary update", parent)
-    dialog.set_modal(True)
+    # modal only if parent is, to let searches run meanwhile
+    dialog.set_modal(parent.get_modal())
     dialog.set_resizable(False)
     dialog.set_size_request(350, -1)
 
@@ -227,7 +384,21 @@ class JpydictApp:
     class AbortException(Exception):
       pass
 
-    def reporter(msg, progress):
+    aborted = threading.Event()
+    def on_destroy(w):
+      aborted.set()
+      self.update_dialog = None
+    dialog.connect('destroy', on_destroy)
+
+    parent_alive = [True]
+    def on_parent_destroy(w):
+      parent_alive[0] = False
+      dialog.set_modal(False)  # don't block the main window
+    parent_handler = parent.connect('destroy', on_parent_destroy)
+
+    def show_progress(msg, progress):
+      if aborted.is_set():
+        return False
       if msg is None:
         label.set_text("Dictionary update")
         bar.set_fraction(1)
@@ -237,23 +408,123 @@ class JpydictApp:
           bar.pulse()
         else:
           bar.set_fraction(progress)
-      if not dialog.get_visible():
-        raise AbortException()  # dialog has been closed, abort
-      while Gtk.events_pending():
-        Gtk.main_iteration()
+      return False
 
+    def reporter(msg, progress):
+      # called from the update thread
+      if aborted.is_set():
+        raise AbortException()  # dialog has been closed, abort
+      GLib.idle_add(show_progress, msg, progress)
+
+    def finish(updated, error):
+      if updated:
+        self.conn.close()
+        self.conn = sqlite3.connect(self.db)
+        self.load_completer()
+        if self.results_txt:
+          self.worker.search(self.results_txt)  # refresh displayed results
+      if error is not None and not aborted.is_set():
+        label.set_text("Dictionary update failed: %s" % error)
+      elif not aborted.is_set():
+        dialog.destroy()
+      if parent_alive[0]:
+        parent.disconnect(parent_handler)
+        if on_update:
+          on_update()
+      return False
+
+    def run():
+      updated, error = False, None
+      try:
+        updated = update_database(self.db, reporter)
+      except AbortException:
+        pass  # ignore
+      except Exception as e:
+        traceback.print_exc()
+        error = e
+      GLib.idle_add(finish, updated, error)
+
+    self.update_dialog = dialog
     dialog.present()
-    while Gtk.events_pending():
-      Gtk.main_iteration()
-    loader = JMDictLoader(self.conn, reporter)
-    try:
-      loader.load_url()
-    except AbortException:
-      pass  # ignore
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
 
-    dialog.destroy()
-    if on_update:
-      on_update()
+
+class SearchWorker(threading.Thread):
+  """Run searches in a background thread
+
+  Searches use a dedicated read-only connection, reopened when the database
+  file is replaced. Only the last requested search matters: starting a new
+  search interrupts the current one, using an SQLite progress handler.
+  Results are fetched by pages of page_size entries and passed to
+  callback(txt, cursor, result, next_cursor) from the GTK main loop, cursor
+  being the one given to search(). Results are stored in cache, if set.
+
+  """
+
+  # Number of SQLite virtual machine instructions between cancellation checks
+  progress_steps = 1000
+
+  def __init__(self, db, callback, page_size, cache=None):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.db = db
+    self.callback = callback
+    self.page_size = page_size
+    self.cache = cache
+    self.cond = threading.Condition()
+    self.request = None
+    # incremented on each request, used to detect outdated searches
+    self.generation = 0
+
+  def search(self, txt, cursor=None):
+    """Search a page of results, from cursor (first page if None)"""
+    with self.cond:
+      self.generation += 1
+      self.request = (self.generation, txt, cursor)
+      self.cond.notify()
+
+  def cancel(self):
+    with self.cond:
+      self.generation += 1
+      self.request = None
+
+  def run(self):
+    conn, ident, filled = None, None, False
+    current = [None]
+    while True:
+      with self.cond:
+        while self.request is None:
+          self.cond.wait()
+        current[0], txt, cursor = self.request
+        self.request = None
+      st = os.stat(self.db)
+      if (st.st_dev, st.st_ino) != ident:
+        # first search, or database replaced
+        if conn is not None:
+          conn.close()
+        conn = sqlite3.connect(self.db)
+        conn.execute("PRAGMA query_only = 1")
+        conn.set_progress_handler(lambda: current[0] != self.generation, self.progress_steps)
+        ident, filled = (st.st_dev, st.st_ino), database_is_filled(conn)
+      if not filled:
+        # no dictionary yet
+        GLib.idle_add(self.post_result, current[0], txt, cursor, [], None)
+        continue
+      try:
+        result, next_cursor = Query(conn, txt, limit=self.page_size, cache=self.cache).execute_page(cursor)
+      except sqlite3.Error:
+        if current[0] != self.generation:
+          continue  # interrupted by a newer search
+        traceback.print_exc()
+        continue
+      GLib.idle_add(self.post_result, current[0], txt, cursor, result, next_cursor)
+
+  def post_result(self, generation, *args):
+    if generation == self.generation:
+      self.callback(*args)
+    return False
 
 
 class Query:
@@ -263,28 +534,55 @@ class Query:
     conn -- SQLite Connection object
     to_jp -- search for Japanese translation (default: False)
     pattern -- search pattern, with (converted) wildcards
+    filters -- tag filters, entries must have a tag matching each filter
     limit -- maximum number of results (no limit: negative number, the default)
+    cache -- QueryCache used to store results, or None
+    profiler -- Profiler used to time executed statements, or None
+    lang -- language of searched and returned glosses (JMdict code)
 
   Instance methods:
     build -- build a query from an ordinary search string
+    literal_prefix -- return the part of the pattern before the first wildcard
+    kana_patterns -- return kana patterns equivalent to a romaji pattern
+    where_clause -- return the SQL condition used to match a field
+    is_broad -- return True if the pattern matches many rows of a field
+    gloss_select -- return the statement searching entries from their glosses
+    selects -- return the statements selecting matching entries
     execute -- execute the query and return the result Entry list
+    execute_page -- execute the query and return a page of results
+    fetch_entries -- return the Entry list for a list of ent_id
 
   Instance attribute:
 
   """
 
   conn = None
+  # n-gram tables of indexed fields
+  ngram_tables = {'keb': 'kanji_gram', 'reb': 'reading_gram'}
 
-  def __init__(self, conn, s=None, to_jp=False, limit=None):
+  # Tag names indexed by tag_id, for each (database file, updated_at)
+  tag_names_cache = {}
+  # Minimum number of rows matched by a broad pattern (see is_broad())
+  broad_rows = 2000
+  # Default language of glosses
+  lang = 'eng'
+
+  def __init__(self, conn, s=None, to_jp=False, limit=None, cache=None, profiler=None, lang=None):
     """Build a query.
     Arguments values may be overwritten by special tags in search string.
+    If lang is None, the default language is used.
 
     """
 
     self.conn = conn
     self.to_jp = to_jp
     self.limit = limit
+    self.cache = cache
+    self.profiler = profiler
+    if lang is not None:
+      self.lang = lang
     self.pattern = None
+    self.filters = []
     if s is not None:
       self.build(s)
 
@@ -297,69 +595,1513 @@ class Query:
       *, % : 0 or more characters
       ?, _ : single character
       / as first character : translate to Japanese
+      #tag : only entries with the given tag (pos, field, ...), or with a tag
+        starting with it if there is no such tag; can be repeated
 
     """
 
     if not s:
       return ''
 
+    self.filters = re.findall(ur'(?:^|\s)[#＃](\S+)', s)
+    s = re.sub(ur'(?:^|\s)[#＃]\S+', '', s).strip()
+    if not s:
+      self.pattern = '%'  # filters only
+      return
+
     if s[0] == '/':
       self.to_jp = True
       s = s[1:]
     s = re.sub(ur'[*＊％]', '%', s)
     s = re.sub(ur'[?？＿]', '_', s)
+    if not self.to_jp and re.match('^[ -~]*$', s):
+      # romaji are converted from lowercase
+      s = s.lower()
     if re.search(r'[_%]', s) is None:
       self.pattern = s + '%'
     else:
       self.pattern = s
 
+  def literal_prefix(self, pattern=None):
+    """Return the part of the pattern (default: query pattern) before the first wildcard"""
+    if pattern is None:
+      pattern = self.pattern
+    return re.match(r'[^%_]*', pattern).group()
+
+  def kana_patterns(self):
+    """Return kana patterns equivalent to the (romaji) pattern
+
+    Literal parts are converted using romaji2kana(). Parts followed by a '%'
+    may end with an incomplete syllable. Wildcards are kept, they apply to
+    kana instead of latin characters.
+    Return an empty list if the pattern cannot be converted.
+
+    """
+
+    parts = re.split(r'([%_]+)', self.pattern)
+    patterns = ['']
+    for i, part in enumerate(parts):
+      if i % 2:
+        kana = [part]
+      elif part:
+        kana = romaji2kana(part, prefix=i + 1 < len(parts) and '%' in parts[i+1])
+      else:
+        continue
+      patterns = [p + k for p in patterns for k in kana][:romaji2kana_max]
+    return patterns
+
+  def where_clause(self, field, table, indexed=True, patterns=None):
+    """Return a WHERE clause matching table.field against the pattern, and its parameters
+
+    The literal prefix of the pattern (before the first wildcard) is turned
+    into a range condition which can be served by an index. LIKE is only used
+    to check what remains after the prefix. Since LIKE ignores the case of
+    ASCII letters, the range stops before the first one.
+    Patterns starting with a wildcard cannot use this index. For kanji and
+    kana, candidate entries are then selected from the n-gram index, using the
+    n-grams of the literal parts of the pattern. Other fields fall back to a
+    scan.
+
+    If indexed is False, the index on field is not used for the range (it is
+    still used for exact matches).
+
+    If patterns is set, field is matched against any of the given patterns
+    instead of the query pattern. If indexed is True, rows matching each
+    pattern are selected separately, from the index, since SQLite would rather
+    scan another index than use it for OR-ed ranges.
+
+    """
+
+    if patterns is not None:
+      clauses = [self.pattern_clause(field, table, indexed, p) for p in patterns]
+      params = tuple(p for _, clause_params in clauses for p in clause_params)
+      if len(clauses) == 1:
+        return clauses[0]
+      elif indexed:
+        union = ' UNION ALL '.join('SELECT rowid FROM %s WHERE %s' % (table, w) for w, _ in clauses)
+        return '%s.rowid IN (%s)' % (table, union), params
+      else:
+        return '(%s)' % ' OR '.join('(%s)' % w for w, _ in clauses), params
+    return self.pattern_clause(field, table, indexed, self.pattern)
+
+  def pattern_clause(self, field, table, indexed, pattern):
+    """Return a WHERE clause matching table.field against a single pattern
+
+    See where_clause().
+    """
+
+    literal = self.literal_prefix(pattern)
+    # LIKE ignores the case of ASCII letters, ranges and n-grams do not: the
+    # range prefix stops before the first letter, LIKE checks the rest
+    prefix = re.match(r'[^A-Za-z]*', literal).group()
+    column = '%s.%s' % (table, field)
+    if not literal:
+      gram_table = self.ngram_tables.get(field)
+      grams = set()
+      for part in re.split(r'[%_]+', pattern):
+        grams |= set(part) if len(part) == 1 else bigrams(part)
+      grams = set(g for g in grams if not re.search(r'[A-Za-z]', g))
+      if gram_table is None or not grams:
+        return '%s LIKE ?' % column, (pattern,)
+      subquery = ' INTERSECT '.join(["SELECT ent_id FROM %s WHERE gram = ?" % gram_table] * len(grams))
+      return '%s.ent_id IN (%s) AND %s LIKE ?' % (table, subquery, column), tuple(grams) + (pattern,)
+    if not prefix:
+      return '%s LIKE ?' % column, (pattern,)
+    if prefix == pattern:
+      return '%s = ?' % column, (pattern,)
+    upper = prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+    if not indexed:
+      column = '+' + column
+    where = '%s >= ? AND %s < ?' % (column, column)
+    params = (prefix, upper)
+    if pattern != prefix + '%':
+      where += ' AND %s LIKE ?' % column
+      params += (pattern,)
+    return where, params
+
+  def is_broad(self, field, table, patterns=None):
+    """Return True if the pattern prefix matches many rows of table.field
+
+    Results of such patterns are better read in rank order, from the rank
+    index, stopping after limit results. Otherwise, matching rows are read
+    from the field index, then sorted.
+    patterns is passed to where_clause().
+    """
+
+    if self.limit is None or self.limit < 0:
+      return False
+    patterns = patterns or [self.pattern]
+    if any(self.literal_prefix(p) in ('', p) for p in patterns):
+      return False
+    n = 0
+    for p in patterns:
+      where, params = self.pattern_clause(field, table, True, p)
+      n += self.conn.execute("SELECT count(*) FROM (SELECT 1 FROM %s WHERE %s LIMIT ?)" % (table, where),
+                             params + (self.broad_rows - n,)).fetchone()[0]
+      if n >= self.broad_rows:
+        return True
+    return False
+
+  def filter_tags(self):
+    """Return the list of tag ids matched by each filter"""
+
+    names = self.tag_names()
+    result = []
+    for f in self.filters:
+      tag_ids = [i for i, name in names.iteritems() if name == f]
+      if not tag_ids:
+        tag_ids = [i for i, name in names.iteritems() if name.lower().startswith(f.lower())]
+      result.append(tag_ids)
+    return result
+
+  def filter_clause(self, column, filter_tags):
+    """Return a WHERE clause restricting entries to the tag filters, and its parameters
+
+    column is the (qualified) ent_id column of the filtered table. Tags of
+    each candidate entry are checked, which is efficient when the pattern is
+    more selective than the filters.
+    """
+
+    where = ["EXISTS (SELECT 1 FROM sense_tag st WHERE st.ent_id = %s AND st.tag_id IN (%s))"
+             % (column, ','.join('?' * len(tag_ids))) for tag_ids in filter_tags]
+    return ' AND '.join(where), tuple(i for tag_ids in filter_tags for i in tag_ids)
+
+  def fts_query(self):
+    """Return the full-text query matching the pattern, None if there is none
+
+    The literal prefix of the pattern is searched as a phrase whose last token
+    may be a prefix. Patterns starting with a wildcard cannot use the full-text
+    index.
+
+    """
+
+    pattern = self.pattern
+    prefix = self.literal_prefix()
+    if not re.search(r'\w', prefix, re.UNICODE):
+      return None
+    q = '"%s"' % prefix.replace('"', '""')
+    if prefix != pattern:
+      q += ' *'
+    return q
+
+  def gloss_select(self):
+    """Return the statement selecting entries whose glosses match the pattern
+
+    Only glosses in the query language are searched, using its full-text
+    index if available: words are matched anywhere in the gloss and results
+    are ordered by relevance (BM25). Patterns with wildcards after the first
+    word are then checked using LIKE.
+    Otherwise, glosses starting with the pattern are searched using LIKE.
+
+    """
+
+    fts = self.fts_query()
+    table = gloss_fts_table(self.lang)
+    if fts is not None:
+      row = self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (table,)).fetchone()
+      if row is None:
+        fts = None
+    filter_tags = self.filter_tags() if self.filters else None
+    if fts is None:
+      where, params = "lang = ? AND gloss LIKE ?", (self.lang, self.pattern)
+      if filter_tags:
+        filters = self.filter_clause('gloss.ent_id', filter_tags)
+        where += " AND " + filters[0]
+        params += filters[1]
+      return ("SELECT ent_id, min(length(gloss)) AS key FROM gloss WHERE %s GROUP BY ent_id" % where,
+              params)
+
+    where, params = "%s MATCH ?" % table, (fts,)
+    prefix = self.literal_prefix()
+    if self.pattern not in (prefix, prefix + '%'):
+      where += " AND g.gloss LIKE ?"
+      params += (self.pattern,)
+    if filter_tags:
+      filters = self.filter_clause('g.ent_id', filter_tags)
+      where += " AND " + filters[0]
+      params += filters[1]
+    return ("""
+        SELECT ent_id, min(rank) AS key FROM (
+          SELECT g.ent_id AS ent_id, %(t)s.rank AS rank
+          FROM %(t)s JOIN gloss g ON g.rowid = %(t)s.rowid
+          WHERE %(where)s
+        ) GROUP BY ent_id
+        """ % {'t': table, 'where': where}, params)
+
+  def selects(self):
+    """Return statements selecting matching entries, in order of preference
+
+    Each statement returns (ent_id, key) rows, one per ent_id. Results are
+    sorted on key, and only the first statement with results is used.
+
+    Kanji and readings are sorted by rank. When several writings of an entry
+    match, only the best ranked one is kept. This is done without GROUP BY so
+    that rows can be read in rank order from the (rank, ent_id, ...) index.
+
+    """
+
+    if self.to_jp:
+      # To Japanese
+      return [self.gloss_select()]
+    filter_tags = self.filter_tags() if self.filters else None
+    if self.pattern == '%' and filter_tags:
+      # Filters only: get entries from the tags of the first filter
+      tag_ids = filter_tags[0]
+      where = "tag_id IN (%s)" % ','.join('?' * len(tag_ids))
+      params = tuple(tag_ids)
+      if len(filter_tags) > 1:
+        filters = self.filter_clause('sense_tag.ent_id', filter_tags[1:])
+        where += " AND " + filters[0]
+        params += filters[1]
+      return [("SELECT ent_id, ent_id AS key FROM sense_tag WHERE %s GROUP BY ent_id" % where, params)]
+    if re.match('^[ -~]*$', self.pattern):
+      # ASCII only: romaji, searched as kana
+      tables, fields = ('reading',), ('reb',)
+      patterns = self.kana_patterns()
+      if not patterns:
+        return []
+    else:
+      # Unicode: first kanji, then kana
+      tables, fields = ('kanji', 'reading',), ('keb', 'reb',)
+      patterns = None
+    query = """
+        SELECT ent_id, rank AS key FROM %(t)s WHERE %(where)s AND NOT EXISTS (
+          SELECT 1 FROM %(t)s AS dup WHERE dup.ent_id = %(t)s.ent_id AND %(dup_where)s
+          AND (dup.rank < %(t)s.rank OR (dup.rank = %(t)s.rank AND dup.rowid < %(t)s.rowid))
+        )"""
+    selects = []
+    for t,f in zip(tables, fields):
+      # filtered searches are not read in rank order: filters may match few entries
+      broad = not filter_tags and self.is_broad(f, t, patterns)
+      where, params = self.where_clause(f, t, not broad, patterns)
+      dup_where, dup_params = self.where_clause(f, 'dup', False, patterns)
+      if filter_tags:
+        filters = self.filter_clause('%s.ent_id' % t, filter_tags)
+        where += ' AND ' + filters[0]
+        params += filters[1]
+      selects.append((query % {'t': t, 'where': where, 'dup_where': dup_where}, params + dup_params))
+    return selects
+
   def execute(self):
     """Execute the query and return the result Entry list."""
+    return self.execute_page()[0]
+
+  def execute_page(self, cursor=None):
+    """Execute the query and return a page of results
+
+    Return a (result, cursor) pair. result is the Entry list of the page, of
+    at most limit entries. cursor is passed back to get the next page, it is
+    None if there is no next page.
+
+    Pages use keyset pagination: the next page starts after the (key, ent_id)
+    of the last returned entry, key being the sort key of the used statement.
+
+    """
+
+    if self.cache is not None:
+      cache_key = (self.pattern, tuple(self.filters), self.to_jp, self.limit, self.lang, cursor)
+      page = self.cache.get(self.conn, cache_key)
+      if page is not None:
+        return page
+
+    ent_id, cursor = self.select_page(cursor)
+    page = self.fetch_entries(ent_id), cursor
+    if self.cache is not None:
+      self.cache.put(cache_key, page)
+    return page
+
+  def select_page(self, cursor=None):
+    """Return the ent_id list of a page of results, and the next cursor
+
+    See execute_page() for cursor usage.
+    """
 
-    cursor = self.conn.cursor()
     limit = self.limit
     if limit is None:
       limit = -1
+    elif limit == 0:
+      return [], None
+    selects = self.selects()
+
+    def fetch(query, params):
+      sql = "%s ORDER BY key, ent_id LIMIT ?" % query
+      params += (limit + 1 if limit >= 0 else -1,)
+      if self.profiler is not None:
+        return self.profiler.execute(self.conn, sql, params)
+      return self.conn.execute(sql, params).fetchall()
 
     # Get ent_id to display
-    if self.to_jp:
-      # To Japanese
-      tables, fields = ('gloss',), ('gloss',)
-    elif re.match('^[ -~]*$', self.pattern):
-      # ASCII only: romaji
-      tables, fields = ('reading',), ('romaji',)
+    if cursor is None:
+      n, rows = 0, []
+      for n, (query, params) in enumerate(selects):
+        rows = fetch(query, params)
+        if rows:
+          break
     else:
-      # Unicode: first kanji, then kana
-      tables, fields = ('kanji', 'reading',), ('keb', 'reb',)
-    # Fetch results
-    query = "SELECT DISTINCT ent_id FROM %s WHERE %s LIKE ? ORDER BY length(%s) LIMIT ?"
-    for t,f in zip(tables, fields):
-      cursor.execute(query % (t, f, f), (self.pattern, limit))
-      ent_id = [x[0] for x in cursor]
-      if ent_id:
-        break
+      n, key, ent_id = cursor
+      if not 0 <= n < len(selects):
+        raise ValueError("invalid cursor")
+      query, params = selects[n]
+      rows = fetch("SELECT ent_id, key FROM (%s) WHERE key >= ? AND (key > ? OR ent_id > ?)" % query,
+                   params + (key, key, ent_id))
+
+    if limit >= 0 and len(rows) > limit:
+      rows = rows[:limit]
+      cursor = (n, rows[-1][1], rows[-1][0])
+    else:
+      cursor = None
+    return [r[0] for r in rows], cursor
+
+  def fetch_entries(self, ent_id):
+    """Return the Entry list for a list of ent_id"""
 
     ent_id_list = '(%s)' % ','.join(str(i) for i in ent_id)
 
     # Dictionary is not sorted,
     # Entry order is still obtained from ent_id.
-    result = {e: Entry(e) for e in ent_id}
-
-    cursor.execute("SELECT ent_id, keb FROM kanji WHERE ent_id IN %s" % ent_id_list)
-    for s in cursor:
-      result[s[0]].keb.append(s[1])
-    cursor.execute("SELECT ent_id, reb FROM reading WHERE ent_id IN %s" % ent_id_list)
-    for s in cursor:
-      result[s[0]].reb.append(s[1])
-    cursor.execute("SELECT ent_id, sense_num, pos, attr FROM sense WHERE ent_id IN %s ORDER BY ent_id, sense_num" % ent_id_list)
-    for s in cursor:
-      result[s[0]].sense.append((filter(None, s[2].split(',')), filter(None, s[3].split(',')), []))
-    cursor.execute("SELECT ent_id, sense_num, gloss FROM gloss WHERE ent_id IN %s" % ent_id_list)
-    for s in cursor:
-      result[s[0]].sense[s[1]-1][2].append(s[2])
-
+    with profile_timer(self.profiler, 'fetch entries'):
+      tag_names = self.tag_names()
+      cursor = self.conn.execute("SELECT ent_id, data FROM entry WHERE ent_id IN %s" % ent_id_list)
+      result = {s[0]: Entry.from_data(s[0], s[1], tag_names, self.lang) for s in cursor}
     return [result[e] for e in ent_id]
 
+  def tag_names(self):
+    """Return tag names, indexed by tag_id
+
+    Names are read once per database version.
+    """
+    path = self.conn.execute("PRAGMA database_list").fetchone()[2]
+    updated_at = self.conn.execute("SELECT updated_at FROM version").fetchone()[0]
+    key = (path, updated_at)
+    names = self.tag_names_cache.get(key)
+    if names is None:
+      names = dict(self.conn.execute("SELECT tag_id, name FROM tag"))
+      if len(self.tag_names_cache) >= 16:
+        self.tag_names_cache.clear()
+      self.tag_names_cache[key] = names
+    return names
+
+
+class QueryCache:
+  """Cache of query results
+
+  Results are indexed by query parameters (pattern, filters, to_jp, limit,
+  lang, cursor), and the least recently used are discarded when size is
+  reached. The cache is cleared when the dictionary is updated (when
+  version.updated_at changes).
+
+  If path is set, cached results are loaded from this file and saved to it by
+  save(), so that they are kept across restarts.
+
+  Attributes:
+    hits -- number of queries found in cache
+    misses -- number of queries not found in cache
+
+  """
+
+  def __init__(self, size=1000, path=None):
+    self.lru = LRUCache(size)
+    self.path = path
+    self.updated_at = None
+    self.lock = threading.Lock()
+    if path is not None:
+      self.load()
+
+  @property
+  def hits(self):
+    return self.lru.hits
+
+  @property
+  def misses(self):
+    return self.lru.misses
+
+  def get(self, conn, key):
+    """Return a cached result, None if not found
+
+    Check the dictionary version and clear the cache if it changed.
+    """
+    updated_at = conn.execute("SELECT updated_at FROM version").fetchone()[0]
+    with self.lock:
+      if updated_at != self.updated_at:
+        self.lru.clear()
+        self.updated_at = updated_at
+      return self.lru.get(key)
+
+  def put(self, key, value):
+    with self.lock:
+      self.lru.put(key, value)
+
+  def load(self):
+    """Load cached results from path, ignore invalid files"""
+    try:
+      with open(self.path, 'rb') as f:
+        updated_at, items = pickle.load(f)
+      pages = [(key, ([entry_from_fields(*fields) for fields in result], cursor))
+               for key, (result, cursor) in items]
+    except (IOError, EOFError, pickle.UnpicklingError, ValueError, TypeError):
+      return
+    with self.lock:
+      self.lru.clear()
+      self.updated_at = updated_at
+      for key, page in pages:
+        self.lru.put(key, page)
+
+  def save(self):
+    """Save cached results to path"""
+    with self.lock:
+      items = []
+      link = self.lru.root[1]
+      while link is not self.lru.root:
+        result, cursor = link[3]
+        items.append((link[2], ([(e.seq, e.keb, e.reb, e.sense) for e in result], cursor)))
+        link = link[1]
+      data = (self.updated_at, items)
+    # write to a temporary file first, to not leave a truncated file
+    tmp_path = self.path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+      pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+    if os.name == 'nt' and os.path.exists(self.path):
+      os.remove(self.path)
+    os.rename(tmp_path, self.path)
+
+
+class Completer:
+  """Autocompletion of search texts
+
+  Completions are kanji and kana writings, their romaji, and glosses of
+  at most gloss_max_length characters (prefixed with '/', as searched).
+  They are ranked like search results: by priority of the writing (for
+  glosses, of the best reading of their entry), then by length.
+
+  Keys are stored UTF-8 encoded in a single string, sorted, along with arrays
+  of offsets and priorities. The top completions of prefixes matching more
+  than scan_size keys are computed once, when the index is built; others are
+  obtained by scanning the keys of the prefix.
+  If the index (keys and top completions) would exceed memory_budget bytes,
+  the lowest ranked keys are dropped. Memory used while building the index,
+  when all keys are loaded, is not bounded by memory_budget.
+
+  Attributes:
+    size -- number of indexed keys
+    memory -- approximate memory used by the index, in bytes
+
+  """
+
+  # Maximum number of returned completions
+  max_completions = 10
+  # Maximum number of keys scanned to complete a prefix
+  scan_size = 64
+  # Longest completed gloss
+  gloss_max_length = 32
+  # Default memory budget, in bytes
+  memory_budget = 32 << 20
+
+  def __init__(self, conn, lang=None, memory_budget=None):
+    if lang is None:
+      lang = Query.lang
+    if memory_budget is None:
+      memory_budget = self.memory_budget
+
+    # best priority of each key
+    keys = {}
+    def add(rows):
+      get = keys.get
+      for key, priority in rows:
+        if get(key, priority + 1) > priority:
+          keys[key] = priority
+
+    add(conn.execute("SELECT keb, rank FROM kanji"))
+    readings = {}
+    for reb, rank in conn.execute("SELECT reb, rank FROM reading"):
+      if readings.get(reb, rank + 1) > rank:
+        readings[reb] = rank
+    add(readings.iteritems())
+    # romaji are not memoized, most readings are converted once
+    # romaji2kana() does not read -tsu, skip it
+    romajis = ((_kana2romaji(reb, apostrophe=True, warn=False), rank) for reb, rank in readings.iteritems())
+    add((romaji, rank) for romaji, rank in romajis if re.match(r"^[a-z'-]+$", romaji) and '-tsu' not in romaji)
+    readings.clear()
+    # rank of the best reading, then length of the gloss
+    add(('/' + gloss, rank - rank % 64 + min(len(gloss), 63)) for gloss, rank in conn.execute("""
+        SELECT lower(gloss), min(rank) FROM gloss JOIN reading USING (ent_id)
+        WHERE lang = ? AND length(gloss) <= ? GROUP BY gloss
+        """, (lang, self.gloss_max_length)))
+
+    items = [(key.encode('utf-8'), priority) for key, priority in keys.iteritems()]
+    keys.clear()
+    # keep the best ranked keys (key, offset and priority) up to the budget,
+    # then drop more of them while top completions exceed it
+    items.sort(key=lambda item: item[1])
+    keys_budget = memory_budget
+    while True:
+      budget = keys_budget
+      for n, (key, _) in enumerate(items):
+        budget -= len(key) + 8
+        if budget < 0:
+          break
+      else:
+        n = len(items)
+      self.build_index(sorted(items[:n]))
+      if self.memory <= memory_budget or n == 0:
+        break
+      keys_budget -= self.memory - memory_budget
+
+  def build_index(self, items):
+    """Build the index from (key, priority) pairs, sorted by key"""
+    self.offsets = array.array('i', [0])
+    self.priorities = array.array('i')
+    for key, priority in items:
+      self.offsets.append(self.offsets[-1] + len(key))
+      self.priorities.append(priority)
+    self.keys = ''.join(key for key, _ in items)
+    self.size = len(self.priorities)
+
+    self.top = {}
+    self.build_top('', 0, self.size)
+    self.memory = (len(self.keys) + self.offsets.itemsize * len(self.offsets)
+                   + self.priorities.itemsize * len(self.priorities)
+                   + sum(len(p) + 4 * len(t) for p, t in self.top.iteritems()))
+
+  def key(self, i):
+    return self.keys[self.offsets[i]:self.offsets[i+1]]
+
+  def bisect(self, key, lo=0, hi=None):
+    """Return the index of the first key not lower than key (UTF-8 encoded)"""
+    if hi is None:
+      hi = self.size
+    keys, offsets = self.keys, self.offsets
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if keys[offsets[mid]:offsets[mid+1]] < key:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def scan(self, lo, hi):
+    """Return the indexes of the best ranked keys from lo to hi"""
+    return heapq.nsmallest(self.max_completions, xrange(lo, hi), key=self.priorities.__getitem__)
+
+  def build_top(self, prefix, lo, hi):
+    """Compute top completions of a prefix and longer ones, return them
+
+    Keys from lo to hi are the keys starting with prefix.
+    """
+    if hi - lo <= self.scan_size:
+      return self.scan(lo, hi)
+    candidates = []
+    depth = len(prefix)
+    i = lo
+    while i < hi:
+      key = self.key(i)
+      if len(key) == depth:
+        candidates.append(i)  # prefix itself, always first
+        i += 1
+        continue
+      # UTF-8 strings never contain '\xff'
+      child = key[:depth+1]
+      j = self.bisect(child + '\xff', i, hi)
+      candidates.extend(self.build_top(child, i, j))
+      i = j
+    top = heapq.nsmallest(self.max_completions, candidates, key=self.priorities.__getitem__)
+    self.top[prefix] = array.array('i', top)
+    return top
+
+  def complete(self, txt, n=None):
+    """Return the best completions of a text, at most n (default: max_completions)"""
+    if n is None:
+      n = self.max_completions
+    if re.match('^[ -~]*$', txt):
+      txt = txt.lower()  # romaji and glosses are lowercase
+    prefix = txt.encode('utf-8')
+    top = self.top.get(prefix)
+    if top is None:
+      lo = self.bisect(prefix)
+      top = self.scan(lo, self.bisect(prefix + '\xff', lo))
+    return [self.key(i).decode('utf-8') for i in top[:n]]
+
+
+def lookup(conn, terms, limit=None, batch_size=500, profiler=None, lang=None):
+  """Search many terms, yield (term, result) pairs
+
+  Terms are processed by batches: entries matched by all the terms of a batch
+  are fetched at once, and entries matched by several terms are fetched once.
+  Result of each term is an Entry list, as returned by Query.execute().
+  conn may also be a Snapshot. lang is passed to Query.
+
+  """
+
+  query = SnapshotQuery if isinstance(conn, Snapshot) else Query
+
+  def run(batch):
+    matches = {}
+    for term in batch:
+      if term not in matches:
+        matches[term] = query(conn, term, limit=limit, profiler=profiler, lang=lang).select_page()[0]
+    ent_id = list(set(i for l in matches.itervalues() for i in l))
+    entries = dict(zip(ent_id, query(conn, profiler=profiler, lang=lang).fetch_entries(ent_id)))
+    for term in batch:
+      yield term, [entries[i] for i in matches[term]]
+
+  batch = []
+  for term in terms:
+    batch.append(term)
+    if len(batch) >= batch_size:
+      for r in run(batch):
+        yield r
+      batch = []
+  for r in run(batch):
+    yield r
+
+
+class Annotator:
+  """Annotate text with dictionary entries
+
+  Kanji and kana writings of all entries are loaded in memory. Text is
+  segmented in a single pass: at each position, the longest writing starting
+  there is matched, then the text following it is processed. Characters not
+  starting any writing are skipped.
+  Writings are indexed by their first character, along with the lengths of
+  writings starting with it, so that only existing lengths are looked up.
+
+  Matched entries are fetched by batches, and the most recently used ones are
+  kept in an LRU cache.
+
+  Attributes:
+    chars -- number of annotated characters
+
+  """
+
+  # Number of lines whose entries are fetched at once
+  batch_size = 500
+  # Number of cached entries
+  cache_size = 10000
+
+  def __init__(self, conn, profiler=None):
+    self.conn = conn
+    self.profiler = profiler
+    self.entries = LRUCache(self.cache_size)
+    self.chars = 0
+
+    # ent_id of each writing, best ranked first (a single int if there is one)
+    self.words = words = {}
+    lengths = {}
+    rows = conn.execute("""
+        SELECT keb AS word, ent_id, rank FROM kanji
+        UNION ALL SELECT reb, ent_id, rank FROM reading
+        ORDER BY word, rank, ent_id
+        """)
+    for word, group in itertools.groupby(rows, lambda row: row[0]):
+      ent_id = []
+      for _, i, _ in group:
+        if i not in ent_id:
+          ent_id.append(i)
+      words[word] = ent_id[0] if len(ent_id) == 1 else tuple(ent_id)
+      lengths.setdefault(word[0], set()).add(len(word))
+    # lengths of writings starting with each character, longest first
+    self.lengths = {c: tuple(sorted(l, reverse=True)) for c, l in lengths.iteritems()}
+
+  def segment(self, txt):
+    """Yield (start, end, ent_id tuple) of the words of a text"""
+    words, lengths = self.words, self.lengths
+    i, n = 0, len(txt)
+    while i < n:
+      for l in lengths.get(txt[i], ()):
+        if l > n - i:
+          continue
+        ent_id = words.get(txt[i:i+l])
+        if ent_id is not None:
+          yield i, i + l, ent_id if isinstance(ent_id, tuple) else (ent_id,)
+          i += l
+          break
+      else:
+        i += 1
+
+  def fetch_entries(self, ent_id):
+    """Return an {ent_id: Entry} dict, fetch the ones not in cache at once"""
+    result = {}
+    missing = []
+    for i in set(ent_id):
+      e = self.entries.get(i)
+      if e is None:
+        missing.append(i)
+      else:
+        result[i] = e
+    if missing:
+      for e in Query(self.conn, profiler=self.profiler).fetch_entries(missing):
+        self.entries.put(e.seq, e)
+        result[e.seq] = e
+    return result
+
+  def annotate(self, lines, limit=None):
+    """Annotate an iterable of lines, yield (line, words) pairs
+
+    words is a list of (start, end, entries) tuples, entries being a list of
+    at most limit Entry. lines are processed by batches, so that large
+    inputs are streamed.
+
+    """
+
+    def run(batch):
+      with profile_timer(self.profiler, 'segment'):
+        segments = [list(self.segment(line)) for line in batch]
+      ent_id = [i for words in segments for _, _, l in words for i in l[:limit]]
+      with profile_timer(self.profiler, 'fetch entries'):
+        entries = self.fetch_entries(ent_id)
+      for line, words in itertools.izip(batch, segments):
+        self.chars += len(line)
+        yield line, [(start, end, [entries[i] for i in l[:limit]]) for start, end, l in words]
+
+    batch = []
+    for line in lines:
+      batch.append(line)
+      if len(batch) >= self.batch_size:
+        for r in run(batch):
+          yield r
+        batch = []
+    for r in run(batch):
+      yield r
+
+
+def entry_from_fields(seq, keb, reb, sense):
+  e = Entry(seq)
+  e.keb, e.reb, e.sense = keb, reb, sense
+  return e
+
+
+def export_snapshot(conn, path):
+  """Write a Snapshot of a dictionary database to path
+
+  The snapshot is written to a temporary file first, then renamed.
+  """
+
+  entries = array.array('i')
+  data = []
+  size = 0
+  for ent_id, d in conn.execute("SELECT ent_id, data FROM entry ORDER BY ent_id"):
+    d = str(d)
+    entries.extend((ent_id, size, len(d)))
+    data.append(d)
+    size += len(d)
+  index = {ent_id: i for i, ent_id in enumerate(entries[0::3])}
+
+  def glosses(lang):
+    # glosses are keyed from the start of each word
+    for ent_id, gloss in conn.execute("SELECT ent_id, gloss FROM gloss WHERE lang = ?", (lang,)):
+      key = gloss.lower()
+      for m in re.finditer(r'\b\w', key, re.UNICODE):
+        yield key[m.start():], len(gloss), ent_id
+
+  arrays = [
+      ('keb', conn.execute("SELECT keb, rank, ent_id FROM kanji")),
+      ('reb', conn.execute("SELECT reb, rank, ent_id FROM reading")),
+      ('tag', conn.execute("SELECT DISTINCT name, 0, ent_id FROM sense_tag JOIN tag USING (tag_id)")),
+      ]
+  for lang, in conn.execute("SELECT DISTINCT lang FROM gloss ORDER BY lang").fetchall():
+    arrays.append(('gloss:' + lang, glosses(lang)))
+
+  meta = {
+      'version': Snapshot.version,
+      'updated_at': conn.execute("SELECT updated_at FROM version").fetchone()[0],
+      'tag_names': dict(conn.execute("SELECT tag_id, name FROM tag")),
+      'arrays': {},
+      }
+
+  # arrays also sorted by first character and rank (see Snapshot.match_ranked())
+  ranked_arrays = ('keb', 'reb')
+
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'wb') as f:
+    def write(s):
+      f.write('\0' * (-f.tell() % 8))
+      offset = f.tell()
+      f.write(s)
+      return offset
+
+    def write_array(a):
+      if sys.byteorder != 'little':
+        a.byteswap()
+      return write(a.tostring())
+
+    f.write(Snapshot.header.pack(Snapshot.magic, 0, 0))
+    meta['entries'] = (write_array(entries), len(entries) // 3)
+    meta['data'] = (write(''.join(data)), size)
+    del data
+    for name, rows in arrays:
+      rows = sorted((key.replace('\n', ' ').encode('utf-8'), rank, index[ent_id]) for key, rank, ent_id in rows)
+      records = array.array('i')
+      # keys are preceded by a newline too, for like_regex()
+      pool = ['\n']
+      pool_size = 1
+      prev = None
+      ranked = []
+      for key, rank, i in rows:
+        if key != prev:
+          pool.append(key + '\n')
+          key_offset = pool_size
+          pool_size += len(key) + 1
+          prev = key
+          first = key.decode('utf-8')[:1].encode('utf-8')
+        records.extend((key_offset, len(key), rank, i))
+        if name in ranked_arrays:
+          ranked.append((first, rank, i, key_offset, len(key)))
+      meta['arrays'][name] = [write_array(records), len(rows), write(''.join(pool)), pool_size, None]
+      if ranked:
+        ranked.sort()
+        records = array.array('i')
+        for _, rank, i, key_offset, size in ranked:
+          records.extend((key_offset, size, rank, i))
+        meta['arrays'][name][4] = write_array(records)
+    meta_data = json.dumps(meta)
+    meta_offset = write(meta_data)
+    f.seek(0)
+    f.write(Snapshot.header.pack(Snapshot.magic, meta_offset, len(meta_data)))
+  if os.name == 'nt' and os.path.exists(path):
+    os.remove(path)
+  os.rename(tmp_path, path)
+
+
+class Snapshot:
+  """Read-only dictionary snapshot, written by export_snapshot()
+
+  The file is mapped in memory and searched without SQLite: opening it only
+  reads a small header, lookups use binary searches on sorted key arrays.
+
+  File layout (integers are 32-bit little-endian, sections are
+  8-byte aligned):
+    - header: magic, offset and size of the JSON metadata (version,
+      updated_at, tag names, offsets of the other sections);
+    - entries: (ent_id, offset, size) of each entry data, sorted by ent_id;
+    - data: serialized entries, as stored in the database;
+    - for each key array (keb, reb, tag, gloss:LANG for each language):
+      (key offset, key size, rank, entry index) records sorted by key and
+      entry index, then the pool of distinct keys, UTF-8 encoded, sorted and
+      surrounded by newlines;
+      for keb and reb, the same records sorted by first character of the key,
+      rank and entry index.
+
+  Glosses are keyed from the start of each of their words, in lowercase,
+  ranked by length. Tags are keyed by name.
+
+  """
+
+  magic = 'JPYSNAP\0'
+  version = 2
+  header = struct.Struct('<8sII')
+  entry_record = struct.Struct('<iii')
+  key_record = struct.Struct('<iiii')
+
+  def __init__(self, path):
+    self.path = path
+    with open(path, 'rb') as f:
+      self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, offset, size = self.header.unpack_from(self.mm)
+    if magic != self.magic:
+      raise ValueError("not a jpydict snapshot: %s" % path)
+    meta = json.loads(self.mm[offset:offset+size])
+    if meta['version'] != self.version:
+      raise ValueError("unsupported snapshot version: %s" % meta['version'])
+    self.updated_at = meta['updated_at']
+    self.tag_names = {int(k): v for k, v in meta['tag_names'].iteritems()}
+    self.entries = meta['entries']
+    self.data = meta['data']
+    self.arrays = meta['arrays']
+
+  def close(self):
+    self.mm.close()
+
+  def ent_id(self, i):
+    """Return the ent_id of the entry at index i"""
+    return self.entry_record.unpack_from(self.mm, self.entries[0] + 12 * i)[0]
+
+  def entry(self, i, lang=None):
+    """Return the Entry at index i, see Entry.from_data() for lang"""
+    ent_id, offset, size = self.entry_record.unpack_from(self.mm, self.entries[0] + 12 * i)
+    offset += self.data[0]
+    return Entry.from_data(ent_id, self.mm[offset:offset+size], self.tag_names, lang)
+
+  def entry_index(self, ent_id):
+    """Return the index of an entry from its ent_id, None if there is none"""
+    lo, hi = 0, self.entries[1]
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self.ent_id(mid) < ent_id:
+        lo = mid + 1
+      else:
+        hi = mid
+    if lo < self.entries[1] and self.ent_id(lo) == ent_id:
+      return lo
+    return None
+
+  def bisect(self, name, key, i=0):
+    """Return the position of the first record of an array not lower than (key, i)
+
+    key is an UTF-8 string, i an entry index.
+    """
+    records, count, pool, _, _ = self.arrays[name]
+    mm, unpack = self.mm, self.key_record.unpack_from
+    lo, hi = 0, count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      offset, size, _, mid_i = unpack(mm, records + 16 * mid)
+      offset += pool
+      if (mm[offset:offset+size], mid_i) < (key, i):
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def has_tag(self, i, names):
+    """Return True if the entry at index i has a tag among names"""
+    records, count, pool, _, _ = self.arrays['tag']
+    for name in names:
+      name = name.encode('utf-8')
+      pos = self.bisect('tag', name, i)
+      if pos < count:
+        offset, size, _, pos_i = self.key_record.unpack_from(self.mm, records + 16 * pos)
+        if pos_i == i and self.mm[pool+offset:pool+offset+size] == name:
+          return True
+    return False
+
+  def records(self, name, start, stop):
+    """Return (key offsets, ranks, entry indexes) arrays of records from start to stop"""
+    records = self.arrays[name][0]
+    a = array.array('i', self.mm[records + 16 * start:records + 16 * stop])
+    if sys.byteorder != 'little':
+      a.byteswap()
+    return a[0::4], a[2::4], a[3::4]
+
+  def match(self, name, pattern):
+    """Iterate on (rank, entry index) of the records whose key matches a pattern
+
+    pattern is an SQL LIKE pattern, case-sensitive. Its literal prefix
+    is searched by binary search, the rest is checked by a regular expression
+    run on the pool of keys.
+
+    """
+
+    records, count, pool, pool_size, _ = self.arrays[name]
+    pattern = pattern.encode('utf-8')
+    prefix = re.match(r'[^%_]*', pattern).group()
+    if not prefix:
+      start, stop = 0, count
+    elif pattern == prefix:
+      start, stop = self.bisect(name, prefix), self.bisect(name, prefix, 1 << 32)
+    else:
+      # 0xff never appears in UTF-8
+      start, stop = self.bisect(name, prefix), self.bisect(name, prefix + '\xff')
+    if start >= stop:
+      return
+    if pattern in (prefix, prefix + '%'):
+      _, ranks, entries = self.records(name, start, stop)
+      for r in itertools.izip(ranks, entries):
+        yield r
+      return
+
+    mm, unpack = self.mm, self.key_record.unpack_from
+    begin = pool + unpack(mm, records + 16 * start)[0]
+    offset, size, _, _ = unpack(mm, records + 16 * (stop - 1))
+    end = pool + offset + size + 1
+    regex = like_regex(pattern)
+    if prefix:
+      matches = regex.finditer(mm, begin, end)
+    else:
+      matches = self.search_lines(regex, max(re.split(r'[%_]', pattern), key=len), begin, end)
+    pos = start
+    for m in matches:
+      # records are sorted by key, hence by key offset
+      offset = m.start() - pool
+      lo, hi = pos, stop
+      while lo < hi:
+        mid = (lo + hi) // 2
+        if unpack(self.mm, records + 16 * mid)[0] < offset:
+          lo = mid + 1
+        else:
+          hi = mid
+      pos = lo
+      while pos < stop:
+        key_offset, _, rank, i = unpack(self.mm, records + 16 * pos)
+        if key_offset != offset:
+          break
+        yield rank, i
+        pos += 1
+
+
+  def match_ranked(self, name, pattern):
+    """Iterate on sorted (rank, entry index) of the records whose key matches a pattern
+
+    Only patterns made of a single character followed by '%' are supported,
+    on arrays with records sorted by rank: records are read in order, which
+    is faster for broad patterns when only the first results are needed.
+    Return None for other patterns.
+
+    """
+
+    records, count, pool, _, ranked = self.arrays[name]
+    if ranked is None or len(pattern) != 2 or pattern[1] != '%' or pattern[0] in '%_':
+      return None
+    first = pattern[0].encode('utf-8')
+    mm, unpack = self.mm, self.key_record.unpack_from
+
+    def bisect(upper):
+      lo, hi = 0, count
+      while lo < hi:
+        mid = (lo + hi) // 2
+        offset = pool + unpack(mm, ranked + 16 * mid)[0]
+        c = mm[offset:offset+len(first)]
+        if c < first or upper and c == first:
+          lo = mid + 1
+        else:
+          hi = mid
+      return lo
+
+    def iterate(start, stop):
+      for pos in xrange(start, stop):
+        _, _, rank, i = unpack(mm, ranked + 16 * pos)
+        yield rank, i
+
+    return iterate(bisect(False), bisect(True))
+
+  def search_lines(self, regex, literal, begin, end):
+    """Iterate on matches of regex on the lines from begin to end containing literal
+
+    This is faster than running regex on all lines, for patterns starting
+    with a wildcard.
+    """
+    mm = self.mm
+    if not literal:
+      for m in regex.finditer(mm, begin, end):
+        yield m
+      return
+    pos = begin
+    while True:
+      pos = mm.find(literal, pos, end)
+      if pos < 0:
+        return
+      line_begin = mm.rfind('\n', begin - 1, pos) + 1
+      line_end = mm.find('\n', pos, end) + 1
+      m = regex.match(mm, line_begin, line_end)
+      if m is not None:
+        yield m
+      pos = line_end
+
+
+def like_regex(pattern):
+  """Return a regular expression matching lines against an UTF-8 LIKE pattern"""
+  parts = []
+  for s in re.split(r'([%_])', pattern):
+    if s == '%':
+      parts.append(r'[^\n]*')
+    elif s == '_':
+      parts.append(r'(?:[^\n\x80-\xff]|[\xc0-\xff][\x80-\xbf]*)')
+    else:
+      parts.append(re.escape(s))
+  return re.compile('^%s$' % ''.join(parts), re.M)
+
+
+class SnapshotQuery(Query):
+  """Query searching a Snapshot instead of an SQLite database
+
+  conn is a Snapshot; other arguments and methods are the same as Query ones.
+  Results are the same, except for translations to Japanese: there is no
+  full-text index, glosses starting with the pattern at any word are
+  searched, shortest first. Results are not cached.
+
+  """
+
+  def __init__(self, snapshot, s=None, to_jp=False, limit=None, cache=None, profiler=None, lang=None):
+    Query.__init__(self, snapshot, s, to_jp, limit, None, profiler, lang)
+
+  def searches(self):
+    """Return the searches of matching entries, in order of preference
+
+    A search is a list of (key array, pattern) pairs. See Query.selects().
+    """
+    if self.to_jp:
+      name = 'gloss:' + self.lang
+      return [[(name, self.pattern.lower())]] if name in self.conn.arrays else []
+    if self.pattern == '%' and self.filters:
+      return [[]]  # filters only
+    if re.match('^[ -~]*$', self.pattern):
+      patterns = self.kana_patterns()
+      return [[('reb', p) for p in patterns]] if patterns else []
+    return [[('keb', self.pattern)], [('reb', self.pattern)]]
+
+  def select_page(self, cursor=None):
+    """Return the ent_id list of a page of results, and the next cursor
+
+    See Query.select_page().
+    """
+
+    snapshot = self.conn
+    limit = self.limit
+    if limit is None:
+      limit = -1
+    elif limit == 0:
+      return [], None
+    filter_names = [[snapshot.tag_names[i] for i in tag_ids] for tag_ids in self.filter_tags()]
+
+    def rows(search, after=None):
+      """Return sorted (key, entry index) pairs of a search, at most limit + 1"""
+      ranked = [snapshot.match_ranked(name, pattern) for name, pattern in search]
+      if search and None not in ranked:
+        pairs = heapq.merge(*ranked)
+      elif search:
+        pairs = []
+        for name, pattern in search:
+          pairs.extend(snapshot.match(name, pattern))
+        pairs.sort()
+      else:
+        # filters only: entries are taken from the first filter, sorted by ent_id
+        names = filter_names[0]
+        if len(names) == 1:
+          entries = (i for _, i in snapshot.match('tag', names[0]))
+        else:
+          entries = sorted(set(i for name in names for _, i in snapshot.match('tag', name)))
+        pairs = ((snapshot.ent_id(i), i) for i in entries)  # key is ent_id, like Query
+      # keep the best key of each entry, filters are only checked on kept pairs
+      result = []
+      seen = set()
+      for key, i in pairs:
+        if i in seen:
+          continue
+        seen.add(i)
+        if after is not None and (key, i) <= after:
+          continue
+        if filter_names and not all(snapshot.has_tag(i, names) for names in filter_names):
+          continue
+        result.append((key, i))
+        if len(result) == limit + 1:
+          break
+      return result
+
+    searches = self.searches()
+    with profile_timer(self.profiler, 'snapshot search'):
+      if cursor is None:
+        n, result = 0, []
+        for n, search in enumerate(searches):
+          result = rows(search)
+          if result:
+            break
+      else:
+        n, key, ent_id = cursor
+        if not 0 <= n < len(searches):
+          raise ValueError("invalid cursor")
+        i = snapshot.entry_index(ent_id)
+        result = rows(searches[n], (key, -1 if i is None else i))
+
+    if limit >= 0 and len(result) > limit:
+      result = result[:limit]
+      cursor = (n, result[-1][0], snapshot.ent_id(result[-1][1]))
+    else:
+      cursor = None
+    return [snapshot.ent_id(i) for _, i in result], cursor
+
+  def fetch_entries(self, ent_id):
+    """Return the Entry list for a list of ent_id"""
+    snapshot = self.conn
+    with profile_timer(self.profiler, 'fetch entries'):
+      return [snapshot.entry(snapshot.entry_index(e), self.lang) for e in ent_id]
+
+  def tag_names(self):
+    return self.conn.tag_names
+
+
+class LookupServer(BaseHTTPServer.HTTPServer):
+  """HTTP server for dictionary lookups
+
+  Requests are handled by a pool of threads, each one using its own read-only
+  database connection. Connections are reopened when the database file is
+  replaced, so that the dictionary can be updated while the server is running.
+
+  See LookupRequestHandler for the API.
+
+  """
+
+  # Number of threads handling requests (and keep-alive connections)
+  pool_size = 32
+  # Size of the memory map used by database connections, in bytes
+  mmap_size = 256 << 20
+  allow_reuse_address = True
+
+  def __init__(self, address, db, cache=None, profiler=None):
+    BaseHTTPServer.HTTPServer.__init__(self, address, LookupRequestHandler)
+    self.db = db
+    self.cache = cache
+    self.profiler = profiler
+    self.local = threading.local()
+    self.requests = Queue.Queue()
+    for i in range(self.pool_size):
+      t = threading.Thread(target=self.process_requests)
+      t.daemon = True
+      t.start()
+
+  def process_request(self, request, client_address):
+    self.requests.put((request, client_address))
+
+  def process_requests(self):
+    while True:
+      request, client_address = self.requests.get()
+      try:
+        self.finish_request(request, client_address)
+      except Exception:
+        self.handle_error(request, client_address)
+      finally:
+        self.shutdown_request(request)
+
+  def connection(self):
+    """Return the database connection of the current thread"""
+    st = os.stat(self.db)
+    ident = (st.st_dev, st.st_ino)
+    local = self.local
+    if getattr(local, 'ident', None) != ident:
+      # first use, or database replaced
+      if getattr(local, 'conn', None) is not None:
+        local.conn.close()
+      conn = sqlite3.connect(self.db)
+      conn.execute("PRAGMA query_only = 1")
+      conn.execute("PRAGMA mmap_size = %d" % self.mmap_size)
+      local.conn, local.ident = conn, ident
+    return local.conn
+
+
+class LookupRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Handle lookup requests
+
+  Responses are JSON objects.
+
+  GET /search?q=TEXT[&limit=N][&cursor=CURSOR][&lang=LANG]
+    Search a single text, return {"term", "result", "cursor"}. result is an
+    entry list, cursor is passed back to get the next page (null on the last
+    page).
+
+  POST /lookup {"terms": [TEXT, ...], "limit": N, "lang": LANG}
+    Search many texts at once, return {"results": [{"term", "result"}, ...]}.
+
+  lang is the language of glosses (default: Query.lang). limit is at most
+  max_limit.
+
+  """
+
+  protocol_version = 'HTTP/1.1'
+  server_version = 'jpydict/' + __version__
+  # Close idle keep-alive connections after this delay, in seconds
+  # (an idle connection holds a thread of the server pool)
+  timeout = 2
+  # Maximum number of results per term
+  max_limit = 100
+  # Buffer responses, for them to be sent at once
+  wbufsize = -1
+  disable_nagle_algorithm = True
+
+  def do_GET(self):
+    url = urlparse.urlsplit(self.path)
+    if url.path != '/search':
+      return self.send_json(404, {'error': "not found"})
+    params = urlparse.parse_qs(url.query)
+    try:
+      q = params['q'][0].decode('utf-8').strip()
+      limit = min(max(int(params.get('limit', [25])[0]), 1), self.max_limit)
+      cursor = params.get('cursor')
+      if cursor is not None:
+        cursor = tuple(json.loads(cursor[0]))
+        # statement index, sort key (a float for full-text searches), ent_id
+        if (len(cursor) != 3 or type(cursor[0]) not in (int, long) or type(cursor[2]) not in (int, long)
+            or type(cursor[1]) not in (int, long, float)):
+          raise ValueError("invalid cursor")
+      lang = params.get('lang', [None])[0]
+      if lang is not None:
+        gloss_fts_table(lang)  # check the language code
+    except (KeyError, ValueError, TypeError):
+      return self.send_json(400, {'error': "invalid parameters"})
+    if not q:
+      return self.send_json(400, {'error': "empty search"})
+
+    try:
+      conn = self.server.connection()
+      result, cursor = Query(conn, q, limit=limit, cache=self.server.cache,
+                             profiler=self.server.profiler, lang=lang).execute_page(cursor)
+    except ValueError as e:
+      return self.send_json(400, {'error': str(e)})
+    except sqlite3.Error as e:
+      return self.send_json(500, {'error': str(e)})
+    self.send_json(200, {'term': q, 'result': [e.to_dict() for e in result], 'cursor': cursor})
+
+  def do_POST(self):
+    if self.path != '/lookup':
+      return self.send_json(404, {'error': "not found"})
+    try:
+      data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+      terms = data['terms']
+      if not isinstance(terms, list) or not all(isinstance(t, basestring) for t in terms):
+        raise ValueError("terms must be a list of strings")
+      terms = [t.strip() for t in terms]
+      limit = min(max(int(data.get('limit', 25)), 1), self.max_limit)
+      lang = data.get('lang')
+      if lang is not None:
+        gloss_fts_table(lang)  # check the language code
+    except (KeyError, ValueError, TypeError, AttributeError):
+      return self.send_json(400, {'error': "invalid request"})
+
+    try:
+      conn = self.server.connection()
+      results = [{'term': term, 'result': [e.to_dict() for e in result]}
+                 for term, result in lookup(conn, (t for t in terms if t), limit,
+                                            profiler=self.server.profiler, lang=lang)]
+    except sqlite3.Error as e:
+      return self.send_json(500, {'error': str(e)})
+    self.send_json(200, {'results': results})
+
+  def send_json(self, code, data):
+    body = json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+    if isinstance(body, unicode):
+      body = body.encode('utf-8')
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json; charset=utf-8')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_request(self, code='-', size='-'):
+    pass  # don't log each request, only errors
+
+
+class Profiler:
+  """Collect timings and counters of dictionary loads and queries
+
+  Timers measure the time spent in named phases. Timers can be nested, the
+  time of a phase does not include the time of the phases nested in it.
+  Statements executed by execute() are timed, and their query plan is
+  recorded. Counters are incremented by arbitrary amounts (e.g. row counts).
+
+  If set, sink(kind, name, value) is called for each recorded event, kind
+  being 'time', 'statement', 'count' or 'plan'.
+
+  Attributes:
+    timings -- total time and number of calls of phases, indexed by name
+    statements -- total time and number of calls, indexed by SQL statement
+    counters -- counter values, indexed by name
+    plans -- query plan (list of details) of statements
+
+  """
+
+  def __init__(self, sink=None):
+    self.sink = sink
+    self.timings = collections.defaultdict(lambda: [0., 0])
+    self.statements = collections.defaultdict(lambda: [0., 0])
+    self.counters = collections.defaultdict(int)
+    self.plans = {}
+    self.lock = threading.Lock()
+    self.local = threading.local()
+
+  def timer(self, name):
+    """Return a context manager timing a phase"""
+    return ProfilerTimer(self, name)
+
+  def count(self, name, n=1):
+    self.record('count', name, n)
+
+  def execute(self, conn, sql, params=()):
+    """Execute a statement and return all its rows"""
+    if sql not in self.plans:
+      plan = conn.execute("EXPLAIN QUERY PLAN %s" % sql, params).fetchall()
+      self.record('plan', sql, [row[-1] for row in plan])
+    t0 = time.time()
+    rows = conn.execute(sql, params).fetchall()
+    duration = time.time() - t0
+    stack = self.stack()
+    if stack:
+      stack[-1] += duration
+    self.record('statement', sql, duration)
+    return rows
+
+  def stack(self):
+    """Return the time spent in nested phases, for each running timer"""
+    try:
+      return self.local.stack
+    except AttributeError:
+      self.local.stack = []
+      return self.local.stack
+
+  def record(self, kind, name, value):
+    with self.lock:
+      if kind == 'time':
+        t = self.timings[name]
+      elif kind == 'statement':
+        t = self.statements[name]
+      elif kind == 'count':
+        self.counters[name] += value
+        t = None
+      else:
+        self.plans[name] = value
+        t = None
+      if t is not None:
+        t[0] += value
+        t[1] += 1
+    if self.sink is not None:
+      self.sink(kind, name, value)
+
+  def summary(self):
+    """Return a summary of recorded data, as text"""
+
+    lines = []
+    total = sum(t for t, _ in self.timings.itervalues()) + sum(t for t, _ in self.statements.itervalues())
+    if self.timings:
+      lines.append("Phases:")
+      for name, (t, n) in sorted(self.timings.items(), key=lambda x: -x[1][0]):
+        lines.append("  %-30s %9.3f s  %5.1f%%  %8d calls" % (name, t, 100 * t / (total or 1), n))
+    if self.counters:
+      lines.append("Counters:")
+      for name, n in sorted(self.counters.items()):
+        lines.append("  %-30s %9d" % (name, n))
+    if self.statements:
+      lines.append("Statements:")
+      for sql, (t, n) in sorted(self.statements.items(), key=lambda x: -x[1][0]):
+        lines.append("  %9.3f s  %5.1f%%  %8d calls  %.3f ms/call" % (t, 100 * t / (total or 1), n, 1000 * t / n))
+        lines.append("    %s" % ' '.join(sql.split()))
+        for detail in self.plans.get(sql, []):
+          lines.append("      plan: %s" % detail)
+    return '\n'.join(lines)
+
+
+class ProfilerTimer:
+  """Context manager timing a phase, see Profiler"""
+
+  def __init__(self, profiler, name):
+    self.profiler = profiler
+    self.name = name
+
+  def __enter__(self):
+    self.stack = self.profiler.stack()
+    self.stack.append(0.)
+    self.t0 = time.time()
+
+  def __exit__(self, *exc):
+    duration = time.time() - self.t0
+    nested = self.stack.pop()
+    if self.stack:
+      self.stack[-1] += duration
+    self.profiler.record('time', self.name, duration - nested)
+
+
+class NullTimer:
+  """Context manager doing nothing, used when profiling is disabled"""
+
+  def __enter__(self):
+    pass
+
+  def __exit__(self, *exc):
+    pass
+
+null_timer = NullTimer()
+
+
+def profile_timer(profiler, name):
+  """Return profiler.timer(name), or a null timer if profiler is None"""
+  if profiler is None:
+    return null_timer
+  return profiler.timer(name)
+
 
 class Entry:
   """Dictionary entry.
@@ -370,6 +2112,10 @@ class Entry:
     reb -- kana writings
     sense -- definition list (pos list, attr. list, gloss list)
 
+  Glosses of parsed entries are indexed by language: gloss lists are
+  replaced by {lang: gloss list} dicts. Entries created from stored data only
+  have the glosses of a given language.
+
   """
 
   def __init__(self, seq):
@@ -378,59 +2124,461 @@ class Entry:
     self.reb = []
     self.sense = []
 
+  def to_data(self, tag_ids):
+    """Serialize the entry, as stored in the database
+
+    Tags (pos and attributes) are stored as ids, given by tag_ids.
+    """
+    sense = [([tag_ids[t] for t in pos], [tag_ids[t] for t in attr], gloss) for pos, attr, gloss in self.sense]
+    data = [self.keb, self.reb, sense]
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+  def to_dict(self):
+    """Return the entry as a dict, suitable for JSON output"""
+    return {
+        'seq': self.seq,
+        'keb': self.keb,
+        'reb': self.reb,
+        'sense': [{'pos': pos, 'attr': attr, 'gloss': gloss} for pos, attr, gloss in self.sense],
+        }
+
+  @classmethod
+  def from_data(cls, seq, data, tag_names, lang=None):
+    """Create an entry from its serialized data
+
+    tag_names maps tag ids to tag names. Only glosses in lang are kept (all
+    of them if lang is None), senses without gloss are dropped.
+    """
+    self = cls(seq)
+    self.keb, self.reb, sense = json.loads(str(data))
+    name = tag_names.__getitem__
+    self.sense = []
+    for pos, attr, glosses in sense:
+      if lang is None:
+        gloss = [g for l in sorted(glosses) for g in glosses[l]]
+      else:
+        gloss = glosses.get(lang)
+      if gloss:
+        self.sense.append((map(name, pos), map(name, attr), gloss))
+    return self
+
+
+class JMDictParser:
+  """Parse JMdict XML to database rows.
+
+  entry_parsed(ent_id, hash, rows) is called for each parsed entry. rows is a
+  dict of row lists, indexed by table name. hash is computed from entry content to detect changes
+  between dictionary versions.
+
+  Tags (entity names used for pos and attributes) are stored as integer ids.
+  tag_ids maps names to ids, ids are assigned to new entities when they are
+  declared.
+
+  If languages is set, only glosses in these languages (JMdict codes, e.g.
+  'eng', 'ger') are kept. Senses without kept gloss are dropped.
+  """
+
+  # Profiler used to time parsing steps, or None
+  profiler = None
+
+  # Rank of priority tags (ke_pri, re_pri), lower is better
+  # nfXX tags (word frequency) are ranked XX, from 1 to 48.
+  priority_ranks = {
+      'news1': 24, 'ichi1': 24, 'spec1': 24, 'gai1': 24,
+      'news2': 48, 'ichi2': 48, 'spec2': 48, 'gai2': 48,
+      }
+  # Rank of words without priority
+  no_priority_rank = 63
+
+  # Tables filled from the dictionary: name, definition, indexes
+  tables = [
+      ('kanji', """(
+        ent_id INT NOT NULL,
+        keb TINYTEXT NOT NULL,
+        rank INT NOT NULL
+      )""", [('k_ent', 'ent_id'), ('k_keb', 'keb'), ('k_rank', 'rank, ent_id, keb')]),
+      ('reading', """(
+        ent_id INT NOT NULL,
+        reb TINYTEXT NOT NULL,
+        rank INT NOT NULL
+      )""", [('r_ent', 'ent_id'), ('r_reb', 'reb'), ('r_rank', 'rank, ent_id, reb')]),
+      ('sense_tag', """(
+        ent_id INT NOT NULL,
+        sense_num INT NOT NULL,
+        tag_id INT NOT NULL,
+        PRIMARY KEY (ent_id, sense_num, tag_id)
+      ) WITHOUT ROWID""", [('st_tag', 'tag_id, ent_id')]),
+      ('gloss', """(
+        ent_id INT NOT NULL,
+        sense_num INT NOT NULL,
+        lang VARCHAR(5) NOT NULL,
+        gloss TEXT NOT NULL
+      )""", [('g_sense', 'ent_id, sense_num')]),
+      ('entry', """(
+        ent_id INTEGER PRIMARY KEY,
+        data BLOB NOT NULL,
+        hash CHAR(32) NOT NULL
+      )""", []),
+      # n-grams of kanji and kana writings, for searches starting with a wildcard
+      ('kanji_gram', """(
+        gram VARCHAR(2) NOT NULL,
+        ent_id INT NOT NULL,
+        PRIMARY KEY (gram, ent_id)
+      ) WITHOUT ROWID""", []),
+      ('reading_gram', """(
+        gram VARCHAR(2) NOT NULL,
+        ent_id INT NOT NULL,
+        PRIMARY KEY (gram, ent_id)
+      ) WITHOUT ROWID""", []),
+      ]
+
+  def __init__(self, entry_parsed, tag_ids=None, languages=None):
+    self.entry_parsed = entry_parsed
+    self.tag_ids = {} if tag_ids is None else tag_ids
+    self.languages = None if languages is None else frozenset(languages)
+    self.parser = xml.parsers.expat.ParserCreate()
+    self.parser.StartElementHandler = self.startElement
+    self.parser.EndElementHandler = self.endElement
+    self.parser.CharacterDataHandler = self.characterData
+    self.parser.EntityDeclHandler = self.entityDecl
+
+  def rank(self, txt, priorities):
+    """Return the rank of a kanji or reading, lower is better
+
+    Words are ranked by priority, then by length.
+    """
+    rank = self.no_priority_rank
+    for p in priorities:
+      if p.startswith('nf'):
+        rank = min(rank, int(p[2:]))
+      else:
+        rank = min(rank, self.priority_ranks.get(p, self.no_priority_rank))
+    return rank * 64 + min(len(txt), 63)
+
+
+  # Collect entity declarations, to back-resolve entities
+  def entityDecl(self, entityName, is_parameter_entity, value, base, systemId, publicId, notationName):
+    self.entities[value] = entityName
+    self.tag_descriptions[entityName] = value
+    if entityName not in self.tag_ids:
+      self.tag_ids[entityName] = max(self.tag_ids.values() or [0]) + 1
+
+  def startDocument(self):
+    self.entities = {}
+    self.tag_descriptions = {}
+    self.cur_entry = None
+    self.cur_sense = None
+    self.txt = None
+
+  def startElement(self, name, attrs):
+    self.txt = ''
+    if name == 'entry':
+      self.sense = 0
+      self.entry = Entry(None)
+      self.rows = {t: [] for t, _, _ in self.tables}
+    elif name in ('k_ele', 'r_ele'):
+      self.priorities = []
+    elif name == 'sense':
+      self.pos = []
+      self.attr = []
+      self.glosses = {}
+    elif name == 'gloss':
+      self.lang = attrs.get('xml:lang', 'eng')
+
+  def endElement(self, name):
+    self.txt = self.txt.strip()
+    if name == 'entry':
+      e = self.entry
+      rows = self.rows
+      # data keeps tag order and duplicates, not stored in table rows
+      data = e.to_data(self.tag_ids)
+      h = hashlib.md5(repr([data] + [rows[t] for t, _, _ in self.tables])).hexdigest()
+      rows['entry'].append((self.cur_entry, data, h))
+      rows['kanji_gram'].extend((g, self.cur_entry) for g in set().union(*map(ngrams, e.keb)))
+      rows['reading_gram'].extend((g, self.cur_entry) for g in set().union(*map(ngrams, e.reb)))
+      self.entry_parsed(self.cur_entry, h, rows)
+    elif name == 'ent_seq':
+      self.cur_entry = int(self.txt)
+    elif name == 'keb':
+      self.entry.keb.append(self.txt)
+    elif name == 'reb':
+      self.entry.reb.append(self.txt)
+    elif name in ('ke_pri', 're_pri'):
+      self.priorities.append(self.txt)
+    elif name == 'k_ele':
+      keb = self.entry.keb[-1]
+      self.rows['kanji'].append((self.cur_entry, keb, self.rank(keb, self.priorities)))
+    elif name == 'r_ele':
+      reb = self.entry.reb[-1]
+      self.rows['reading'].append((self.cur_entry, reb, self.rank(reb, self.priorities)))
+    elif name == 'sense':
+      if self.glosses:
+        tag_ids = set(self.tag_ids[t] for t in self.pos + self.attr)
+        self.rows['sense_tag'].extend((self.cur_entry, self.sense, t) for t in sorted(tag_ids))
+        self.entry.sense.append((self.pos, self.attr, self.glosses))
+      self.sense += 1
+    elif name == 'pos':
+      self.pos.append(self.entities[self.txt])
+    elif name in ('field', 'dial'):
+      self.attr.append(self.entities[self.txt])
+    elif name == 'gloss':
+      if self.languages is None or self.lang in self.languages:
+        self.rows['gloss'].append((self.cur_entry, self.sense, self.lang, self.txt))
+        self.glosses.setdefault(self.lang, []).append(self.txt)
 
-class JMDictLoader:
+  def characterData(self, content):
+    self.txt += content
+
+
+class JMDictLoader(JMDictParser):
   """Load JMdict to database.
 
   output can be either an sqlite3 connection or a filename.
 
+  Parsed rows are written by batches to staging tables, so that memory usage
+  does not depend on dictionary size. Staging tables are indexed and replace
+  the current tables in a single transaction once the whole dictionary has been
+  processed. If loading fails, the database is left unchanged.
+
   reporter is a method used to report loading progress:
     reporter(step, progress)
   Where step is a string describing current step and progress the progress of
   the current step, from 0 to 1, None if unknown.
   reporter(None, None) is called at the end.
+
+  If incremental is True and the database has been filled by a compatible
+  version, only entries which have been added, changed or removed since the
+  last load are updated. Entries are compared by ent_seq, using a hash of their
+  content. Update counts are available in the counts attribute.
+
+  If processes is greater than 1, the XML document is split at entry
+  boundaries and chunks are parsed by a pool of processes. Rows are still
+  written to the database by the calling process.
+
+  If profiler is set, loading phases are timed and written rows are counted.
+  When parsing in parallel, only the time spent waiting for worker processes
+  is measured.
+
+  url is the URL used by load_url(), jmdict_url by default. If download_path
+  is set, the downloaded file is kept there, see load_url().
+
+  If languages is set, only glosses in these languages are loaded (see
+  JMDictParser). Each loaded language has its own full-text index.
+
+  The URL (if loaded by load_url()) and languages of the last load are stored
+  in the database, see database_source().
   """
 
   # Last JMdict version (English only)
   jmdict_url = 'http://ftp.monash.edu.au/pub/nihongo/JMdict_e.gz'
-
-  def __init__(self, db_output, reporter):
+  # Last JMdict version, all languages
+  jmdict_multilingual_url = 'http://ftp.monash.edu.au/pub/nihongo/JMdict.gz'
+
+  # Size of blocks read from the network, in bytes
+  download_block_size = 1 << 16
+  # Maximum number of downloaded blocks waiting to be processed
+  download_queue_size = 64
+
+  # Number of entries parsed before buffered rows are written to the database
+  batch_size = 10000
+  # Size of XML chunks parsed by worker processes, in bytes
+  chunk_size = 1 << 20
+  # Version of the database schema, incremental loads require the same version
+  schema_version = 7
+
+  def __init__(self, db_output, reporter, incremental=False, processes=1, profiler=None,
+               url=None, download_path=None, languages=None):
+    JMDictParser.__init__(self, self.entry_parsed, languages=languages)
     if not isinstance(db_output, sqlite3.Connection):
       db_output = sqlite3.connect(db_output)
     self.db_output = db_output
     self.reporter = reporter
-    self.parser = xml.parsers.expat.ParserCreate()
-    self.parser.StartElementHandler = self.startElement
-    self.parser.EndElementHandler = self.endElement
-    self.parser.CharacterDataHandler = self.characterData
-    self.parser.EntityDeclHandler = self.entityDecl
+    self.incremental = incremental
+    self.processes = processes
+    self.profiler = profiler
+    self.url = self.jmdict_url if url is None else url
+    self.download_path = download_path
+    self.counts = None
+    self.loaded_url = None
 
   def load_url(self):
-    """Load JMdict from public URL
+    """Load JMdict from URL
+
+    The (gzipped) file is downloaded in a separate thread, and processed while
+    it is downloaded.
 
-    Download and process by chunks to have progress and parallelize a bit.
+    If download_path is set, the downloaded file is kept there, along with
+    HTTP validators of the downloaded version. If the dictionary has not
+    changed since the last download, it is not loaded again (unless the
+    database is not filled, or the last load of the file failed).
+    Interrupted downloads are resumed.
+
+    Return True if the dictionary has been loaded.
     """
 
-    result = urllib2.urlopen(self.jmdict_url)
+    self.loaded_url = self.url
+    path = self.download_path
+    meta = self.read_download_meta()
+    headers = {}
+    part_size = 0
+    if meta.get('etag') or meta.get('last_modified'):
+      if meta['complete'] and os.path.exists(path):
+        if meta.get('etag'):
+          headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+          headers['If-Modified-Since'] = meta['last_modified']
+      elif not meta['complete'] and os.path.exists(path + '.part'):
+        part_size = os.path.getsize(path + '.part')
+        headers['Range'] = 'bytes=%d-' % part_size
+        headers['If-Range'] = meta.get('etag') or meta['last_modified']
+
+    self.reporter("Download and process XML dictionary file", None)
+    try:
+      result = urllib2.urlopen(urllib2.Request(self.url, headers=headers))
+    except urllib2.HTTPError as e:
+      if e.code == 304:
+        # not modified since the last download
+        if meta.get('loaded') and database_is_filled(self.db_output):
+          self.reporter("Dictionary is already up to date", 1)
+          self.reporter(None, None)
+          return False
+        self.load_file(path)
+        self.set_download_loaded()
+        return True
+      elif e.code == 416 and part_size:
+        # partial download cannot be resumed, start again
+        os.remove(path + '.part')
+        return self.load_url()
+      raise
+
+    info = result.info()
+    if result.getcode() != 206:
+      part_size = 0  # complete file has been sent
     try:
-      total_size = float(result.info().getheader('Content-Length').strip())
+      content_size = int(info.getheader('Content-Length').strip())
+      total_size = float(content_size + part_size)
     except AttributeError:
-      total_size = None
+      content_size = total_size = None
+
+    out = None
+    if path is not None:
+      self.write_download_meta({
+          'url': self.url,
+          'etag': info.getheader('ETag'),
+          'last_modified': info.getheader('Last-Modified'),
+          'complete': False,
+          'loaded': False,
+          })
+      out = open(path + '.part', 'ab' if part_size else 'wb')
+
+    # Download blocks in a separate thread
+    blocks = Queue.Queue(self.download_queue_size)
+    stop = threading.Event()
+
+    def put(item):
+      while not stop.is_set():
+        try:
+          blocks.put(item, timeout=0.1)
+          return
+        except Queue.Full:
+          pass  # check whether processing has been aborted
+
+    def download():
+      try:
+        size = 0
+        while not stop.is_set():
+          block = result.read(self.download_block_size)
+          if not block:
+            break
+          size += len(block)
+          if out is not None:
+            out.write(block)
+          put(block)
+        else:
+          return  # processing aborted
+        if content_size is not None and size < content_size:
+          raise IOError("download interrupted")
+        if out is not None:
+          out.close()
+          if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+          os.rename(path + '.part', path)
+          meta = self.read_download_meta()
+          meta['complete'] = True
+          self.write_download_meta(meta)
+        put('')  # end of file
+      except Exception:
+        put(sys.exc_info())
+      finally:
+        if out is not None:
+          out.close()
+
+    def chunks():
+      dec = zlib.decompressobj(32 + zlib.MAX_WBITS)  # offset 32 to skip the header
+      read_size = 0
+      # process already downloaded data first
+      if part_size:
+        with open(path + '.part', 'rb') as f:
+          while read_size < part_size:
+            block = f.read(min(self.download_block_size, part_size - read_size))
+            read_size += len(block)
+            with profile_timer(self.profiler, 'decompress'):
+              yield dec.decompress(block)
+      thread = threading.Thread(target=download)
+      thread.daemon = True
+      thread.start()
+      while True:
+        self.reporter("Download and process XML dictionary file",
+                      None if total_size is None else read_size / total_size)
+        with profile_timer(self.profiler, 'download'):
+          block = blocks.get()
+        if isinstance(block, tuple):
+          raise block[0], block[1], block[2]  # download failed
+        if not block:
+          break
+        read_size += len(block)
+        with profile_timer(self.profiler, 'decompress'):
+          yield dec.decompress(block)
 
-    dec = zlib.decompressobj(32 + zlib.MAX_WBITS)  # offset 32 to skip the header
-    read_size = 0
-    self.startDocument()
-    while True:
-      self.reporter("Download and process XML dictionary file",
-                    None if total_size is None else read_size / total_size)
-      chunk = result.read(10240)
-      if not chunk:
-        break
-      read_size += len(chunk)
-      self.parser.Parse(dec.decompress(chunk))
-    self.parser.Parse('', True)
-    self.endDocument()
+    try:
+      self.load_chunks(chunks())
+    finally:
+      stop.set()
+    if path is not None:
+      self.set_download_loaded()
     self.reporter(None, None)
+    return True
+
+  def read_download_meta(self):
+    """Return information on the file downloaded to download_path
+
+    Return an empty dict if there is no such file or if it has been downloaded
+    from another URL.
+    """
+    if self.download_path is None:
+      return {}
+    try:
+      with open(self.download_path + '.json') as f:
+        meta = json.load(f)
+    except (IOError, ValueError):
+      return {}
+    if meta.get('url') != self.url:
+      return {}
+    return meta
+
+  def write_download_meta(self, meta):
+    with open(self.download_path + '.json', 'w') as f:
+      json.dump(meta, f)
+
+  def set_download_loaded(self):
+    """Mark the downloaded file as loaded, once the database has been committed
+
+    Until then, a "not modified" response does not skip the load.
+    """
+    meta = self.read_download_meta()
+    meta['loaded'] = True
+    self.write_download_meta(meta)
+
 
   def load_file(self, path):
     """Load JMdict from a file"""
@@ -440,114 +2588,408 @@ class JMDictLoader:
     else:
       f = open(path, 'rb')
     self.reporter("Process XML dictionary file", None)
-    self.startDocument()
-    self.parser.ParseFile(f)
-    self.endDocument()
+
+    def read():
+      with profile_timer(self.profiler, 'read'):
+        return f.read(1 << 16)
+
+    self.load_chunks(iter(read, ''))
     self.reporter(None, None)
 
+  def load_chunks(self, chunks):
+    """Load JMdict from an iterable of XML data chunks"""
 
-  # Collect entity declarations, to back-resolve entities
-  def entityDecl(self, entityName, is_parameter_entity, value, base, systemId, publicId, notationName):
-    self.entities[value] = entityName
+    self.startDocument()
+    try:
+      if self.processes > 1:
+        self.parse_parallel(chunks)
+      else:
+        for chunk in chunks:
+          with profile_timer(self.profiler, 'parse'):
+            self.parser.Parse(chunk)
+        with profile_timer(self.profiler, 'parse'):
+          self.parser.Parse('', True)
+      self.endDocument()
+    except:
+      self.abortDocument()
+      raise
+
+  def parse_parallel(self, chunks):
+    """Parse XML data chunks using a pool of processes
+
+    The prolog (with entity declarations) and the end of the document are
+    parsed by the loader's parser. Entries in between are split in chunks
+    parsed by worker processes, each chunk being prefixed with the prolog.
+    Results are processed in document order, the number of pending chunks is
+    bounded to limit memory usage.
+
+    """
+
+    pool = multiprocessing.Pool(self.processes)
+    try:
+      pending = collections.deque()
+      prolog = None
+      for kind, data in split_entries(chunks, self.chunk_size):
+        if kind == 'entries':
+          pending.append(pool.apply_async(_parse_entries, (prolog, data, self.tag_ids, self.languages)))
+          if len(pending) > 2 * self.processes:
+            self.add_entries(self.wait_entries(pending.popleft()))
+          continue
+        if kind == 'prolog':
+          prolog = data
+        else:
+          while pending:
+            self.add_entries(self.wait_entries(pending.popleft()))
+        with profile_timer(self.profiler, 'parse'):
+          self.parser.Parse(data, kind == 'tail')
+    finally:
+      pool.terminate()
+
+  def wait_entries(self, result):
+    with profile_timer(self.profiler, 'parse (wait for workers)'):
+      return result.get()
+
+  def add_entries(self, entries):
+    for args in entries:
+      self.entry_parsed(*args)
 
   def startDocument(self):
-    self.entities = {}
-    self.cur_entry = None
-    self.cur_sense = None
-    self.txt = None
-    self.kanji_values = []
-    self.reading_values = []
-    self.sense_values = []
-    self.gloss_values = []
+    JMDictParser.startDocument(self)
+    self.values = {name: [] for name, _, _ in self.tables}
+    self.batch_entries = 0
+    self.counts = {'added': 0, 'changed': 0, 'removed': 0, 'unchanged': 0}
 
+    # Transactions are handled explicitly, DDL statements included
+    conn = self.db_output
+    self.isolation_level = conn.isolation_level
+    conn.isolation_level = None
+
+    # Keep ids of known tags, so that they don't change between loads
+    try:
+      self.tag_ids = dict(conn.execute("SELECT name, tag_id FROM tag"))
+    except sqlite3.OperationalError:
+      self.tag_ids = {}
+
+    # Hashes of current entries, None for a full load
+    self.hashes = None
+    if self.incremental and database_is_filled(conn):
+      self.hashes = dict(conn.execute("SELECT ent_id, hash FROM entry"))
+      self.seen = set()
+    # Rows are written to staging tables, swapped in at the end
+    for name, definition, _ in self.tables:
+      conn.execute("DROP TABLE IF EXISTS %s_new" % name)
+      conn.execute("CREATE TABLE %s_new %s" % (name, definition))
+
+  def entry_parsed(self, ent_id, hash, rows):
+    if self.hashes is not None:
+      self.seen.add(ent_id)
+      old_hash = self.hashes.get(ent_id)
+      if old_hash == hash:
+        self.counts['unchanged'] += 1
+        return
+      self.counts['added' if old_hash is None else 'changed'] += 1
+    for name, values in rows.items():
+      if name == 'entry':
+        values = [(i, buffer(data), h) for i, data, h in values]
+      self.values[name].extend(values)
+    self.batch_entries += 1
+    if self.batch_entries >= self.batch_size:
+      self.flush()
+
+  def flush(self):
+    """Write buffered rows to staging tables"""
+
+    conn = self.db_output
+    with profile_timer(self.profiler, 'write rows'):
+      conn.execute("BEGIN")
+      for name, values in self.values.items():
+        if values:
+          conn.executemany("INSERT INTO %s_new VALUES (%s)" % (name, ','.join('?' * len(values[0]))), values)
+          if self.profiler is not None:
+            self.profiler.count('rows: %s' % name, len(values))
+          del values[:]
+      conn.execute("COMMIT")
+    if self.profiler is not None:
+      self.profiler.count('entries written', self.batch_entries)
+    self.batch_entries = 0
 
   def endDocument(self):
+    self.flush()
     self.reporter("Updating database", None)
+    conn = self.db_output
+    conn.execute("BEGIN")
+    if self.hashes is None:
+      self.swap_tables()
+    else:
+      with profile_timer(self.profiler, 'merge tables'):
+        self.merge_tables()
+    languages = None if self.languages is None else ','.join(sorted(self.languages))
+    conn.execute("UPDATE version SET updated_at = ?, url = ?, languages = ?",
+                 (int(time.time()), self.loaded_url, languages))
+    with profile_timer(self.profiler, 'commit'):
+      conn.execute("COMMIT")
+    #conn.execute('VACUUM')
+    conn.isolation_level = self.isolation_level
+
+    counts = self.counts
+    if self.hashes is None:
+      counts['added'] = conn.execute("SELECT count(*) FROM entry").fetchone()[0]
+      msg = "Dictionary loaded: %d entries" % counts['added']
+    else:
+      msg = "Dictionary updated: %d added, %d changed, %d removed" % (
+          counts['added'], counts['changed'], counts['removed'])
+    self.reporter(msg, 1)
+
+  def swap_tables(self):
+    """Index staging tables and replace current tables with them"""
+
+    conn = self.db_output
+    for s in fts_tables(conn) + ['version', 'tag'] + [name for name, _, _ in self.tables]:
+      conn.execute("DROP TABLE IF EXISTS %s" % s)
+    for name, _, indexes in self.tables:
+      for index, columns in indexes:
+        with profile_timer(self.profiler, 'create indexes'):
+          conn.execute("CREATE INDEX %s ON %s_new (%s)" % (index, name, columns))
+      conn.execute("ALTER TABLE %s_new RENAME TO %s" % (name, name))
+
+    # Full-text indexes for translations to Japanese, one per language
+    with profile_timer(self.profiler, 'create full-text index'):
+      for lang, in conn.execute("SELECT DISTINCT lang FROM gloss").fetchall():
+        if not self.create_fts(lang):
+          break  # FTS5 not available, glosses will be searched using LIKE
+        conn.execute("INSERT INTO %s (rowid, gloss) SELECT rowid, gloss FROM gloss WHERE lang = ?"
+                     % gloss_fts_table(lang), (lang,))
+
+    conn.execute("""
+    CREATE TABLE tag (
+      tag_id INTEGER PRIMARY KEY,
+      name VARCHAR(20) NOT NULL,
+      description TEXT NOT NULL
+    )
+    """)
+    self.write_tags()
+
+    conn.execute("""
+    CREATE TABLE version (
+      updated_at INT NOT NULL,
+      schema INT NOT NULL,
+      url TEXT,
+      languages TEXT
+    )
+    """)
+    conn.execute("INSERT INTO version VALUES (?, ?, NULL, NULL)", (0, self.schema_version))
+
+  def create_fts(self, lang):
+    """Create the full-text index of a language, return False if FTS5 is not available"""
+    try:
+      self.db_output.execute("CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(gloss, content='gloss')"
+                             % gloss_fts_table(lang))
+    except sqlite3.OperationalError:
+      return False
+    return True
+
+  def write_tags(self):
+    """Write tags declared by the dictionary"""
+    self.db_output.executemany("INSERT OR REPLACE INTO tag VALUES (?, ?, ?)", (
+        (tag_id, name, self.tag_descriptions[name])
+        for name, tag_id in self.tag_ids.items() if name in self.tag_descriptions))
+
+  def merge_tables(self):
+    """Replace modified and removed entries with the content of staging tables"""
+
+    conn = self.db_output
+    removed = set(self.hashes).difference(self.seen)
+    self.counts['removed'] = len(removed)
+    conn.execute("CREATE TEMP TABLE stale (ent_id INTEGER PRIMARY KEY)")
+    conn.executemany("INSERT INTO stale VALUES (?)", ((i,) for i in removed))
+    conn.execute("INSERT OR IGNORE INTO stale SELECT ent_id FROM entry_new")
+
+    # languages of removed and added glosses, having a full-text index
+    fts = bool(fts_tables(conn))
+    if fts:
+      langs = [lang for lang, in conn.execute("""
+          SELECT DISTINCT lang FROM gloss WHERE ent_id IN (SELECT ent_id FROM stale)
+          UNION SELECT DISTINCT lang FROM gloss_new
+          """)]
+      fts = all(self.create_fts(lang) for lang in langs)
+    if fts:
+      for lang in langs:
+        conn.execute("""
+        INSERT INTO %(t)s (%(t)s, rowid, gloss)
+        SELECT 'delete', rowid, gloss FROM gloss WHERE ent_id IN (SELECT ent_id FROM stale) AND lang = ?
+        """ % {'t': gloss_fts_table(lang)}, (lang,))
+    for name, _, _ in self.tables:
+      conn.execute("DELETE FROM %s WHERE ent_id IN (SELECT ent_id FROM stale)" % name)
+      conn.execute("INSERT INTO %s SELECT * FROM %s_new" % (name, name))
+      conn.execute("DROP TABLE %s_new" % name)
+    if fts:
+      for lang in langs:
+        conn.execute("""
+        INSERT INTO %s (rowid, gloss)
+        SELECT rowid, gloss FROM gloss WHERE ent_id IN (SELECT ent_id FROM stale) AND lang = ?
+        """ % gloss_fts_table(lang), (lang,))
+    conn.execute("DROP TABLE stale")
+    self.write_tags()
+
+  def abortDocument(self):
+    """Cancel a load, leave the database unchanged"""
+
+    conn = self.db_output
+    try:
+      conn.execute("ROLLBACK")
+    except sqlite3.OperationalError:
+      pass  # no transaction in progress
+    for name, _, _ in self.tables:
+      conn.execute("DROP TABLE IF EXISTS %s_new" % name)
+    conn.isolation_level = self.isolation_level
 
-    with self.db_output as conn:
-      for s in ('kanji', 'reading', 'sense', 'gloss', 'version'):
-        conn.execute("DROP TABLE IF EXISTS %s" % s)
 
-      conn.execute("""
-      CREATE TABLE kanji (
-        ent_id INT NOT NULL,
-        keb TINYTEXT NOT NULL
-      )
-      """)
-      conn.execute("""
-      CREATE TABLE reading (
-        ent_id INT NOT NULL,
-        reb TINYTEXT NOT NULL,
-        romaji TINYTEXT NOT NULL
-      )
-      """)
-      conn.execute("""
-      CREATE TABLE sense (
-        ent_id INT NOT NULL,
-        sense_num INT NOT NULL,
-        pos VARCHAR(50) NOT NULL,
-        attr VARCHAR(50) NOT NULL,
-        PRIMARY KEY (ent_id, sense_num)
-      )
-      """)
-      conn.execute("""
-      CREATE TABLE gloss (
-        ent_id INT NOT NULL,
-        sense_num INT NOT NULL,
-        lang VARCHAR(5) NOT NULL,
-        gloss TEXT NOT NULL
-      )
-      """)
-      conn.execute("""
-      CREATE TABLE version (
-        updated_at INT NOT NULL
-      )
-      """)
+def database_is_filled(conn):
+  """Return True if the database has been filled by a compatible version"""
+  try:
+    row = conn.execute("SELECT schema FROM version").fetchone()
+  except sqlite3.OperationalError:
+    return False  # no database or old schema
+  return row is not None and row[0] == JMDictLoader.schema_version
 
-      conn.executemany("INSERT INTO kanji VALUES (?,?)", self.kanji_values)
-      conn.executemany("INSERT INTO reading VALUES (?,?,?)", self.reading_values)
-      conn.executemany("INSERT INTO sense VALUES (?,?,?,?)", self.sense_values)
-      conn.executemany("INSERT INTO gloss VALUES (?,?,?,?)", self.gloss_values)
 
-      conn.execute("CREATE INDEX k_ent ON kanji (ent_id)")
-      conn.execute("CREATE INDEX r_ent ON reading (ent_id)")
-      conn.execute("CREATE INDEX g_sense ON gloss (ent_id, sense_num)")
+def database_source(conn):
+  """Return the (url, languages) of the last load of a filled database
 
-      conn.execute("INSERT INTO version VALUES (?)", (int(time.time()),))
-      #conn.execute('VACUUM')
-      conn.commit()
+  url is None if the dictionary has been loaded from a file, languages is
+  None if all languages have been loaded.
+  """
+  url, languages = conn.execute("SELECT url, languages FROM version").fetchone()
+  return url, None if languages is None else languages.split(',')
 
 
-  def startElement(self, name, attrs):
-    self.txt = ''
-    if name == 'entry':
-      self.sense = 0
-    elif name == 'sense':
-      self.pos = []
-      self.attr = []
-    elif name == 'gloss':
-      self.lang = attrs.get('xml:lang', 'en')
+def gloss_fts_table(lang):
+  """Return the name of the full-text index of glosses in lang"""
+  if not re.match(r'^[a-z]+$', lang):
+    raise ValueError("invalid language: %r" % lang)
+  return 'gloss_fts_' + lang
 
-  def endElement(self, name):
-    self.txt = self.txt.strip()
-    if name == 'ent_seq':
-      self.cur_entry = int(self.txt)
-    elif name == 'keb':
-      self.kanji_values.append((self.cur_entry, self.txt))
-    elif name == 'reb':
-      self.reading_values.append((self.cur_entry, self.txt, kana2romaji(self.txt)))
-    elif name == 'sense':
-      self.sense_values.append((self.cur_entry, self.sense, ','.join(self.pos), ','.join(self.attr)))
-      self.sense += 1
-    elif name == 'pos':
-      self.pos.append(self.entities[self.txt])
-    elif name in ('field', 'dial'):
-      self.attr.append(self.entities[self.txt])
-    elif name == 'gloss':
-      self.gloss_values.append((self.cur_entry, self.sense, self.lang, self.txt))
 
-  def characterData(self, content):
-    self.txt += content
+def fts_tables(conn):
+  """Return the names of the full-text indexes of glosses"""
+  # 'gloss_fts' is the index of all languages, used by schema 5
+  return [name for name, in conn.execute("""
+      SELECT name FROM sqlite_master WHERE name LIKE 'gloss\\_fts%' ESCAPE '\\'
+      AND sql LIKE 'CREATE VIRTUAL TABLE %'
+      """)]
+
+
+def update_database(db, reporter, **kwargs):
+  """Load the dictionary into a new database file, then replace db with it
+
+  The dictionary is loaded by a JMDictLoader (kwargs are passed to it) into
+  db + '.new', which starts as a copy of db, to update it incrementally.
+  Unless set, url and languages are the ones of the last load of db (see
+  database_source()), and the downloaded file is kept next to db.
+  Once loaded, the new file is renamed to db. This is atomic (except on
+  Windows): connections opened on db keep reading the previous version until
+  they are reopened. If loading fails, db is left unchanged.
+
+  Return True if db has been replaced.
+  """
+
+  new_db = db + '.new'
+  for path in (new_db, new_db + '-journal'):
+    if os.path.exists(path):
+      os.remove(path)  # left by an interrupted update
+  conn = sqlite3.connect(db)
+  filled = database_is_filled(conn)
+  if filled:
+    url, languages = database_source(conn)
+    kwargs.setdefault('url', url)
+    kwargs.setdefault('languages', languages)
+  conn.close()
+  if filled:
+    shutil.copyfile(db, new_db)
+  if kwargs.get('url') is None:
+    kwargs['url'] = JMDictLoader.jmdict_url
+  kwargs.setdefault('download_path', download_cache_path(db, kwargs['url']))
+
+  loader = JMDictLoader(new_db, reporter, incremental=filled, **kwargs)
+  loaded = False
+  try:
+    loaded = loader.load_url()
+  finally:
+    loader.db_output.close()
+    if not loaded:
+      os.remove(new_db)
+  if not loaded:
+    return False
+  if os.name == 'nt':
+    os.remove(db)
+  os.rename(new_db, db)
+  return True
+
+
+def download_cache_path(db, url):
+  """Return the path of the dictionary file downloaded from url, for db
+
+  Downloaded files are kept next to the database.
+  """
+  if url is None:
+    return None
+  return os.path.join(os.path.dirname(os.path.abspath(db)), os.path.basename(url))
+
+
+def _parse_entries(prolog, data, tag_ids, languages):
+  """Parse a chunk of JMdict entries, return entry_parsed() arguments"""
+
+  entries = []
+  parser = JMDictParser(lambda *args: entries.append(args), tag_ids, languages)
+  parser.startDocument()
+  parser.parser.Parse(prolog)
+  parser.parser.Parse(data)
+  parser.parser.Parse('</JMdict>', True)
+  return entries
+
+
+def split_entries(chunks, size):
+  """Split XML data chunks at entry boundaries
+
+  Yield (kind, data) pairs, kind being one of:
+    prolog -- document start, up to the first entry
+    entries -- complete entries, about size bytes
+    tail -- remaining data, until the end of the document
+
+  """
+
+  parts, length = [], 0
+  prolog = False
+  for chunk in chunks:
+    parts.append(chunk)
+    length += len(chunk)
+    if not prolog:
+      data = ''.join(parts)
+      i = data.find('<entry>')
+      if i < 0:
+        parts = [data]
+        continue
+      yield 'prolog', data[:i]
+      prolog = True
+      parts, length = [data[i:]], len(data) - i
+    if length >= size:
+      data = ''.join(parts)
+      i = data.rfind('</entry>') + len('</entry>')
+      if i < len('</entry>'):
+        parts = [data]
+        continue
+      yield 'entries', data[:i]
+      parts, length = [data[i:]], len(data) - i
+  yield 'tail', ''.join(parts)
+
+
+def bigrams(txt):
+  """Return the set of 2-character substrings of a string"""
+  return set(txt[i:i+2] for i in range(len(txt) - 1))
+
+def ngrams(txt):
+  """Return the set of n-grams indexed for a string (characters and bigrams)"""
+  return set(txt) | bigrams(txt)
 
 
 tbl_hiragana = [
@@ -605,22 +3047,290 @@ tbl_symbols = [
     ]
 
 tbl_all = tbl_hiragana + tbl_katakana + tbl_symbols
-kana2romaji_regex = re.compile('|'.join(s for s, _ in tbl_all))
 kana2romaji_map = dict(tbl_all)
 
+# Other romanizations (Kunrei-shiki, Nihon-shiki, input methods)
+tbl_romaji_variants = [
+    ('si', 'shi'), ('ti', 'chi'), ('tu', 'tsu'), ('hu', 'fu'), ('zi', 'ji'),
+    ('di', 'ji'), ('du', 'zu'),
+    ('sya', 'sha'), ('syu', 'shu'), ('syo', 'sho'),
+    ('tya', 'cha'), ('tyu', 'chu'), ('tyo', 'cho'),
+    ('cya', 'cha'), ('cyu', 'chu'), ('cyo', 'cho'),
+    ('zya', 'ja'), ('zyu', 'ju'), ('zyo', 'jo'),
+    ('jya', 'ja'), ('jyu', 'ju'), ('jyo', 'jo'),
+    ('dya', 'ja'), ('dyu', 'ju'), ('dyo', 'jo'),
+    ]
+
+def _romaji2kana_tables():
+  """Return syllable and incomplete syllable tables used by romaji2kana()
+
+  Both tables map romaji to a (hiragana list, katakana list) pair.
+  Incomplete syllables are mapped to the first kana of the syllables starting
+  with them.
+
+  """
+
+  small = u'ぁぃぅぇぉァィゥェォ'
+  syllables = {}
+  for k, r in tbl_hiragana:
+    if k not in small:
+      hira, kata = syllables.setdefault(r, ([], []))
+      hira.append(k)
+      kata.append(''.join(unichr(ord(c)+0x60) for c in k))
+  for k, r in tbl_katakana:
+    kata = syllables.setdefault(r, ([], []))[1]
+    if k not in small and k not in kata:
+      kata.append(k)
+  for r, other in tbl_romaji_variants:
+    for l, other_l in zip(syllables.setdefault(r, ([], [])), syllables[other]):
+      l.extend(k for k in other_l if k not in l)
+
+  partials = {}
+  for r, alts in syllables.iteritems():
+    for i in range(1, len(r)):
+      partials.setdefault(r[:i], ([], []))
+  for p, alts in partials.iteritems():
+    # syllables starting with p, including p itself (e.g. n)
+    for r in sorted(r for r in syllables if r.startswith(p)):
+      for l, r_alts in zip(alts, syllables[r]):
+        l.extend(k[0] for k in r_alts if k[0] not in l)
+  for c in romaji_sokuon_consonants:
+    for l, k in zip(partials[c], u'っッ'):
+      l.append(k)
+  return syllables, partials
+
+# Consonants doubled by a sokuon
+romaji_sokuon_consonants = 'bcdfghjkmprstvwz'
+romaji2kana_syllables, romaji2kana_partials = _romaji2kana_tables()
+# Maximum number of kana candidates of a romaji text
+romaji2kana_max = 32
+
+
+class LRUCache:
+  """Mapping of bounded size, discarding least recently used items
+
+  Items are kept in a circular doubly linked list, most recently used first.
+
+  Attributes:
+    size -- maximum number of items
+    hits -- number of successful lookups
+    misses -- number of failed lookups
+
+  """
+
+  def __init__(self, size):
+    self.size = size
+    self.hits = 0
+    self.misses = 0
+    self.clear()
+
+  def __len__(self):
+    return len(self.items)
+
+  def get(self, key, default=None):
+    link = self.items.get(key)
+    if link is None:
+      self.misses += 1
+      return default
+    self.hits += 1
+    root = self.root
+    if link[1] is not root:
+      # move the link at the front
+      prev, next_ = link[0], link[1]
+      prev[1], next_[0] = next_, prev
+      last = root[0]
+      link[0], link[1] = last, root
+      last[1] = root[0] = link
+    return link[3]
+
+  def put(self, key, value):
+    link = self.items.get(key)
+    if link is not None:
+      link[3] = value
+      self.get(key)
+      return
+    root = self.root
+    if len(self.items) >= self.size:
+      # reuse the least recently used link
+      link = root[1]
+      del self.items[link[2]]
+      root[1], link[1][0] = link[1], root
+    last = root[0]
+    link = [last, root, key, value]
+    last[1] = root[0] = self.items[key] = link
+
+  def clear(self):
+    self.items = {}
+    self.root = root = []  # [prev, next, key, value]
+    root[:] = [root, root, None, None]
+
+
+kana2romaji_cache = LRUCache(10000)
+
 
 def kana2romaji(txt):
+  """Convert kana to romaji, results are memoized
+
+  Searches convert romaji to kana instead (see romaji2kana()), this is only
+  used by external tools, such as benchmark.py.
+  """
   txt = unicode(txt)
-  txt = kana2romaji_regex.sub(lambda m: kana2romaji_map[m.group()], txt)
-  txt = re.sub(ur'[っッ]([bcdfghjkmnprstvwz])', r'\1\1', txt)
-  txt = re.sub(ur'([aeiou])ー', r'\1\1', txt)
-  txt = re.sub(ur'[・ー−―]', '-', txt)
-  txt = re.sub(ur'[っッ]', r'-tsu', txt)
-  txt = re.sub(ur'[\uff00-\uff5e]', lambda m: unichr(ord(m.group(0)) - 0xfee0), txt)
+  romaji = kana2romaji_cache.get(txt)
+  if romaji is None:
+    romaji = _kana2romaji(txt)
+    kana2romaji_cache.put(txt, romaji)
+  return romaji
+
+
+def romaji2kana(txt, prefix=False):
+  """Return the kana texts which may be romanized as txt
+
+  Syllables are converted by longest match, using the kana2romaji() table and
+  common variants (si, tu, zya, ...). Then:
+    - a doubled consonant, or 'tch', is a sokuon;
+    - n is a syllabic n if not followed by a voyel or y ("n'" forces it);
+      if followed by one, both readings are returned (kinen: きねん, きんえん);
+    - long voyels are ambiguous: oo and ou match both おお and おう, ee and ei
+      both えい and ええ, and a long voyel mark (mostly used in katakana);
+    - '-' is a long voyel mark.
+
+  If prefix is True, txt may end with an incomplete syllable, which matches
+  the kana such a syllable could start with.
+
+  Hiragana texts are returned first (n starting a syllable first), then
+  katakana ones, then texts starting with katakana and ending with hiragana.
+  At most romaji2kana_max texts are returned, none if txt cannot be converted.
+
+  """
+
+  syllables = romaji2kana_syllables
+  n = len(txt)
+  # n followed by a voyel or y is ambiguous (kinen: きねん or きんえん), each
+  # reading is a branch: (position, previous voyel, tokens parsed so far)
+  branches = [(0, None, [])]
+
+  def parse(i, prev, tokens):
+    # return tokens, (hiragana alternatives, katakana alternatives) pairs
+    while i < n:
+      if prefix and txt[i:] in romaji2kana_partials:
+        tokens.append(romaji2kana_partials[txt[i:]])
+        break
+      c = txt[i]
+      if c == '-':
+        tokens.append(([u'ー'], [u'ー']))
+        i += 1
+        continue
+      if c in romaji_sokuon_consonants and (txt[i+1:i+2] == c or txt[i:i+3] == 'tch'):
+        tokens.append(([u'っ'], [u'ッ']))
+        prev = None
+        i += 1
+        continue
+      if c == 'n' and txt[i+1:i+2] not in ('a', 'i', 'u', 'e', 'o', 'y'):
+        tokens.append(([u'ん'], [u'ン']))
+        prev = None
+        # "n'" and "nn" (not followed by a voyel) are a single syllabic n
+        i += 2 if txt[i+1:i+2] == "'" or (txt[i+1:i+2] == 'n' and txt[i+2:i+3] not in ('a', 'i', 'u', 'e', 'o', 'y')) else 1
+        continue
+      if c == 'n' and txt[i-1:i] != 'n':
+        branches.append((i + 1, None, tokens + [([u'ん'], [u'ン'])]))
+      for l in (3, 2, 1):
+        r = txt[i:i+l]
+        alts = syllables.get(r)
+        if alts is not None:
+          break
+      else:
+        return None
+      if r in ('o', 'u') and prev == 'o' or r in ('e', 'i') and prev == 'e' or r == prev:
+        # long voyel
+        other = {('o', 'o'): 'u', ('o', 'u'): 'o', ('e', 'e'): 'i', ('e', 'i'): 'e'}.get((prev, r))
+        hira, kata = list(alts[0]), [u'ー'] + alts[1]
+        if other is not None:
+          hira += syllables[other][0]
+          kata += syllables[other][1]
+        hira.append(u'ー')
+        alts = hira, kata
+        prev = None
+      else:
+        prev = r[-1]
+      tokens.append(alts)
+      i += l
+    return tokens
+
+  readings = []
+  while branches and len(readings) < romaji2kana_max:
+    tokens = parse(*branches.pop(0))
+    if tokens is not None:
+      readings.append(tokens)
+
+  result = []
+  for script in (0, 1):
+    texts = itertools.chain.from_iterable(
+        itertools.product(*[alts[script] for alts in tokens]) for tokens in readings)
+    result += itertools.islice(texts, romaji2kana_max // 3)
+  # katakana followed by hiragana (e.g. ローマじ), first alternatives only
+  for tokens in readings:
+    for i in range(1, len(tokens)):
+      result += itertools.product(*[alts[1][:1] for alts in tokens[:i]] + [alts[0][:1] for alts in tokens[i:]])
+  return [u''.join(t) for t in result[:romaji2kana_max]]
+
+
+def _kana2romaji(txt, apostrophe=False, warn=True):
+  """Convert kana to romaji, in a single pass
+
+  Kana are converted by longest match using kana2romaji_map. Then:
+    - sokuon doubles the next consonant, or becomes -tsu;
+    - if apostrophe is True, a syllabic n followed by a voyel, y or n is
+      written n', and sokuon does not double n (as read by romaji2kana());
+    - a long vowel mark doubles the preceding vowel, or becomes a dash,
+      like other dash characters;
+    - full-width ASCII characters are converted to ASCII.
+
+  Sokuon and long vowel rules apply to converted text, but only to kana and
+  ASCII characters: full-width characters are converted last.
+  Characters which cannot be converted are replaced by '?' (with a warning,
+  unless warn is False).
+
+  """
+
+  table = kana2romaji_map
+  out = []
+  prev = None  # last character, before sokuon and long vowel substitutions
+  sokuon = False  # sokuon waiting for the next character
+  i, n = 0, len(txt)
+  while i < n:
+    s = table.get(txt[i:i+2]) if i + 1 < n else None
+    if s is None:
+      c = txt[i]
+      s = table.get(c, c)
+      i += 1
+    else:
+      i += 2
+
+    if sokuon:
+      sokuon = False
+      out.append(s[0] if s[0] in (romaji_sokuon_consonants if apostrophe else 'bcdfghjkmnprstvwz') else '-tsu')
+    elif apostrophe and prev == 'n' and s[0] in 'aiueoyn':
+      out.append("'")
+    if s in u'っッ':
+      sokuon = True
+    elif s == u'ー':
+      out.append(prev if prev in ('a', 'e', 'i', 'o', 'u') else '-')
+    elif s in u'・−―':
+      out.append('-')
+    elif u'\uff00' <= s <= u'\uff5e':
+      out.append(unichr(ord(s) - 0xfee0))
+    else:
+      out.append(s)
+    prev = s[-1]
+  if sokuon:
+    out.append('-tsu')
+
+  txt = u''.join(out)
   try:
     txt = str(txt)
   except UnicodeEncodeError, e:
-    print 'Warning: characters not translated in "%s"' % repr(txt)
+    if warn:
+      print 'Warning: characters not translated in "%s"' % repr(txt)
     txt = txt.encode('ascii', 'replace')
   return txt
 
@@ -631,16 +3341,65 @@ def main():
   parser.add_argument('-d', '--database', metavar='FILE',
       help="SQLite database to use")
   group = parser.add_mutually_exclusive_group()
-  group.add_argument('--import', dest='import_url', action='store_true',
-      help="import JMdict from public URL")
+  group.add_argument('--import', dest='import_public', action='store_true',
+      help="import JMdict from public URL (of the multilingual version if --languages is set)")
+  group.add_argument('--import-url', metavar='URL',
+      help="import JMdict from an URL")
   group.add_argument('--import-file', metavar='FILE',
       help="import JMdict from a file")
+  parser.add_argument('--incremental', action='store_true',
+      help="on import, only update entries changed since the last import")
+  parser.add_argument('--languages', metavar='LANG[,LANG...]',
+      help="on import, only keep glosses in these languages (JMdict codes, e.g. eng,ger; default: all)")
+  parser.add_argument('--lang', metavar='LANG',
+      help="language of searched and displayed glosses (default: %s)" % Query.lang)
+  parser.add_argument('--export-snapshot', metavar='FILE',
+      help="write a read-only snapshot of the dictionary (after import, if any)")
+  parser.add_argument('--snapshot', metavar='FILE',
+      help="search a snapshot written by --export-snapshot instead of the database, for --lookup")
+  parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+      help="number of processes used to parse JMdict on import (default: number of CPUs)")
+  parser.add_argument('--lookup', metavar='FILE', nargs='?', const='-',
+      help="search terms read from a file (default: stdin), one per line, and output results as JSON lines, without GUI")
+  parser.add_argument('--annotate', metavar='FILE', nargs='?', const='-',
+      help="segment text read from a file (default: stdin) into dictionary words, output them as JSON lines (one per input line, with entries not output yet), without GUI")
+  parser.add_argument('--limit', type=int, default=10,
+      help="maximum number of results per term, for --lookup and --annotate (default: %(default)s)")
+  parser.add_argument('--serve', metavar='[ADDR:]PORT',
+      help="run an HTTP server for lookups, without GUI")
+  parser.add_argument('--cache-file', metavar='FILE',
+      help="keep search results cached in this file across runs")
+  parser.add_argument('--profile', action='store_true',
+      help="time import and search steps, print a summary on exit")
   parser.add_argument('search', nargs='?',
       help="search text")
   args = parser.parse_args()
 
+  if args.import_public:
+    if args.languages is None:
+      args.import_url = JMDictLoader.jmdict_url
+    else:
+      args.import_url = JMDictLoader.jmdict_multilingual_url
   import_db = args.import_url or args.import_file
 
+  languages = None
+  try:
+    if args.languages is not None:
+      languages = args.languages.split(',')
+      for lang in languages:
+        gloss_fts_table(lang)  # check the language code
+    if args.lang is not None:
+      gloss_fts_table(args.lang)
+      Query.lang = args.lang
+  except ValueError as e:
+    parser.error(str(e))
+
+  profiler = None
+  if args.profile:
+    import atexit
+    profiler = Profiler()
+    atexit.register(lambda: sys.stderr.write(profiler.summary() + '\n'))
+
   if args.database is None:
     import appdirs
     data_dir = appdirs.user_data_dir('jpydict', '')
@@ -658,16 +3417,98 @@ def main():
         # assume all messages fit on 72 chars
         sys.stdout.write("\r%s%s" % (msg, ' ' * (72 - len(msg))))
 
-    loader = JMDictLoader(args.database, reporter)
+    loader = JMDictLoader(args.database, reporter, incremental=args.incremental,
+                          processes=args.jobs, profiler=profiler, url=args.import_url,
+                          download_path=download_cache_path(args.database, args.import_url),
+                          languages=languages)
     if args.import_url:
       loader.load_url()
     elif args.import_file:
       loader.load_file(args.import_file)
 
-  if import_db and not args.search:
+  if args.export_snapshot is not None:
+    conn = sqlite3.connect(args.database)
+    if not database_is_filled(conn):
+      parser.error("dictionary is empty or outdated, import it first")
+    with profile_timer(profiler, 'export snapshot'):
+      export_snapshot(conn, args.export_snapshot)
+    conn.close()
+
+  if args.lookup is not None:
+    if args.snapshot is not None:
+      conn = Snapshot(args.snapshot)
+    else:
+      conn = sqlite3.connect(args.database)
+      conn.execute("PRAGMA query_only = 1")
+      if not database_is_filled(conn):
+        parser.error("dictionary is empty or outdated, import it first")
+    if args.lookup == '-':
+      f = codecs.getreader('utf-8')(sys.stdin)
+    else:
+      f = codecs.open(args.lookup, 'r', 'utf-8')
+    terms = (l.strip() for l in f)
+    out = sys.stdout
+    for term, result in lookup(conn, (t for t in terms if t), args.limit, profiler=profiler):
+      out.write(json.dumps({'term': term, 'result': [e.to_dict() for e in result]},
+                           ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+      out.write('\n')
+    return
+
+  if args.annotate is not None:
+    conn = sqlite3.connect(args.database)
+    conn.execute("PRAGMA query_only = 1")
+    if not database_is_filled(conn):
+      parser.error("dictionary is empty or outdated, import it first")
+    if args.annotate == '-':
+      f = codecs.getreader('utf-8')(sys.stdin)
+    else:
+      f = codecs.open(args.annotate, 'r', 'utf-8')
+    out = sys.stdout
+    t0 = time.time()
+    with profile_timer(profiler, 'load annotator'):
+      annotator = Annotator(conn, profiler)
+    t1 = time.time()
+    # entries are output once, along with the first line using them
+    seen = set()
+    for line, words in annotator.annotate((l.rstrip('\r\n') for l in f), args.limit):
+      new_entries = []
+      for _, _, entries in words:
+        for e in entries:
+          if e.seq not in seen:
+            seen.add(e.seq)
+            new_entries.append(e.to_dict())
+      words = [{'start': start, 'end': end, 'text': line[start:end], 'seq': [e.seq for e in entries]}
+               for start, end, entries in words]
+      out.write(json.dumps({'text': line, 'words': words, 'entries': new_entries},
+                           ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+      out.write('\n')
+    t2 = time.time()
+    sys.stderr.write("Annotated %d characters in %.2fs (%d characters/s, %.2fs to load)\n" % (
+        annotator.chars, t2 - t1, annotator.chars / max(t2 - t1, 1e-6), t1 - t0))
+    return
+
+  if args.serve is not None:
+    addr, _, port = args.serve.rpartition(':')
+    try:
+      server = LookupServer((addr or 'localhost', int(port)), args.database,
+                            QueryCache(path=args.cache_file), profiler)
+    except ValueError:
+      parser.error("invalid server address: %s" % args.serve)
+    print "Serving on http://%s:%d/" % server.server_address[:2]
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      server.server_close()
+      if args.cache_file is not None:
+        server.cache.save()
+    return
+
+  if (import_db or args.export_snapshot) and not args.search:
     return
 
-  app = JpydictApp(args.database)
+  app = JpydictApp(args.database, QueryCache(path=args.cache_file))
   if args.search:
     app.w_search.get_child().set_text(args.search)
     app.w_search.get_child().activate()